@@ -0,0 +1,84 @@
+"""Microbenchmark: JWT signatures per run before and after the SymBotRSAAuth token cache.
+
+Simulates the REST calls made for a batch of ADD rows (entitlement + one call per permission) and
+compares re-reading the key and re-signing for every call (previous behaviour) against the cached
+token returned by SymBotRSAAuth.get_jwt.
+
+Usage:
+    python3 benchmarks/jwt_signing_benchmark.py [--rows 500] [--permissions 3] [--key ./rsa/privateKey.pem]
+
+If no key is given a throwaway 2048-bit RSA key is generated.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from modules.configure import SymConfig
+from modules.rsa_auth import SymBotRSAAuth
+
+
+def generate_key(path):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with open(path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM,
+                                  serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+
+
+def build_config(key_path):
+    config = SymConfig(None)
+    config.data = {'botRSAPath': key_path, 'publicKeyId': 'benchmark'}
+    return config
+
+
+def run_uncached(config, calls):
+    # Previous behaviour: every REST call re-opened the PEM file and signed a new token
+    signatures = 0
+    for _ in range(calls):
+        auth = SymBotRSAAuth(config)
+        auth.create_jwt('WHATSAPP')
+        signatures += auth.jwt_mint_count
+    return signatures
+
+
+def run_cached(config, calls):
+    auth = SymBotRSAAuth(config)
+    for _ in range(calls):
+        auth.get_jwt('WHATSAPP')
+    return auth.jwt_mint_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--permissions', type=int, default=3)
+    parser.add_argument('--key', default=None)
+    args = parser.parse_args()
+
+    calls = args.rows * (1 + args.permissions)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        key_path = args.key
+        if key_path is None:
+            key_path = os.path.join(tmp, 'benchmark-key.pem')
+            generate_key(key_path)
+        config = build_config(key_path)
+
+        print(f'{args.rows} rows x (1 entitlement + {args.permissions} permissions) = {calls} REST calls')
+        for label, run in (('before (sign per call)', run_uncached), ('after (cached token)', run_cached)):
+            start = time.perf_counter()
+            signatures = run(config, calls)
+            elapsed = time.perf_counter() - start
+            print(f'{label:<24} signatures: {signatures:>6}   elapsed: {elapsed:8.3f}s   '
+                  f'per call: {elapsed / calls * 1000:7.3f}ms')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""Local stand-in for the CES admin API and the Symphony pod, used by the benchmarks.
+
+Implements the endpoints used by EntitlementClient and PodUserClient:
+- CES entitlements, permissions and paginated roster (/admin/api/...)
+- Pod RSA authentication, admin user list paging and extension app lists (/login, /relay, /pod/...)
+
+Latency, throttling (429) rate and roster / pod sizes are configurable. The server speaks HTTPS
+with a self-signed certificate so the real clients can be pointed at it through truststorePath.
+
+Standalone usage:
+    python3 benchmarks/mock_server.py --port 8443 --latency-ms 20 --throttle-rate 0.01 --roster-size 1000
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PERMISSIONS = ['create:room', 'create:contact', 'admin:list-customers', 'add:multi-company-contact']
+ADVISOR_PERMISSIONS = re.compile(
+    r'^/admin/api/v2/customer/advisors/([^/]+)/externalNetwork/([^/]+)/permissions(?:/([^/]+))?$')
+ROSTER = re.compile(r'^/admin/api/v1/customer/entitlements/externalNetwork/([^/]+)/advisors$')
+USER_APPS = re.compile(r'^/pod/v1/admin/user/([^/]+)/app/entitlement/list$')
+
+
+def problem(status, title):
+    return status, {'status': status, 'title': title}
+
+
+class MockState():
+    """Entitlements, permissions, pod users and call statistics of the mock server"""
+
+    def __init__(self, roster_size=0, user_count=1000, first_id=100000000000000, app_id='com.symphony.sfs.admin-app',
+                 network='WHATSAPP', page_size=100):
+        self.lock = threading.Lock()
+        self.first_id = first_id
+        self.app_id = app_id
+        self.page_size = page_size
+        self.user_count = user_count
+        self.entitlements = dict()
+        self.permissions = dict()
+        self.installed = dict()
+        self.calls = dict()
+
+        for index in range(roster_size):
+            self.add_entitlement(str(first_id + index), network)
+
+
+    def add_entitlement(self, symphony_id, network):
+        entitlement = {'symphonyId': symphony_id,
+                       'firstName': 'First' + symphony_id,
+                       'lastName': 'Last' + symphony_id,
+                       'displayName': 'Advisor ' + symphony_id,
+                       'externalNetwork': network}
+        self.entitlements[(symphony_id, network)] = entitlement
+        return entitlement
+
+
+    def record_call(self, method, template):
+        with self.lock:
+            key = f'{method} {template}'
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'total_calls': sum(self.calls.values())}
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are sent separately - avoid Nagle / delayed ACK stalls on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        return
+
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+    def send_json(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    def handle_request(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/__stats':
+            return self.send_json(200, server.state.stats())
+
+        if server.latency > 0:
+            time.sleep(max(0.0, random.gauss(server.latency, server.latency * server.jitter)))
+
+        if server.throttle_rate > 0 and random.random() < server.throttle_rate and not url.path.startswith(('/login', '/relay')):
+            server.state.record_call(method, 'throttled')
+            return self.send_json(429, {'status': 429, 'title': 'Too Many Requests'}, {'Retry-After': '0.1'})
+
+        with server.state.lock:
+            status, response = self.route(method, url.path, query, body)
+        self.send_json(status, response)
+
+
+    def route(self, method, path, query, body):
+        """Apply the request to the mock state and return (status, body)"""
+        state = self.server.state
+
+        if path in ('/login/pubkey/authenticate', '/relay/pubkey/authenticate') and method == 'POST':
+            self.record(method, path)
+            return (200, {'token': 'mock-token', 'name': 'sessionToken'})
+
+        if path == '/admin/api/v2/customer/entitlements' and method == 'POST':
+            self.record(method, path)
+            key = (str(body['symphonyId']), body['externalNetwork'])
+            if key in state.entitlements:
+                return problem(409, 'Entitlement already exists')
+            return (201, state.add_entitlement(*key))
+
+        if path == '/admin/api/v2/customer/advisor/entitlements':
+            self.record(method, path)
+            key = (query['advisorSymphonyId'][0], query['externalNetwork'][0])
+            if key not in state.entitlements:
+                return problem(404, 'Entitlement not found')
+            if method == 'GET':
+                return (200, state.entitlements[key])
+            if method == 'DELETE':
+                del state.entitlements[key]
+                state.permissions.pop(key, None)
+                return (204, None)
+
+        match = ADVISOR_PERMISSIONS.match(path)
+        if match:
+            key = (match.group(1), match.group(2))
+            self.record(method, '/admin/api/v2/customer/advisors/{id}/externalNetwork/{network}/permissions'
+                        + ('/{name}' if match.group(3) else ''))
+            if key not in state.entitlements:
+                return problem(404, 'Advisor not entitled')
+            granted = state.permissions.setdefault(key, set())
+            if method == 'GET':
+                return (200, [{'permissionName': name} for name in sorted(granted)])
+            if method == 'POST':
+                if body['permissionName'] not in PERMISSIONS:
+                    return problem(400, 'Unknown permission')
+                granted.add(body['permissionName'])
+                return (201, {'permission': body['permissionName']})
+            if method == 'DELETE':
+                granted.discard(match.group(3))
+                return (204, None)
+
+        if path == '/admin/api/v1/customer/permissions' and method == 'GET':
+            self.record(method, path)
+            return (200, [{'permissionName': name} for name in PERMISSIONS])
+
+        match = ROSTER.match(path)
+        if match and method == 'GET':
+            self.record(method, '/admin/api/v1/customer/entitlements/externalNetwork/{network}/advisors')
+            offset = int(query.get('offset', ['0'])[0])
+            advisors = [e for (symphony_id, network), e in state.entitlements.items() if network == match.group(1)]
+            page = advisors[offset:offset + state.page_size]
+            next_page = f'?offset={offset + state.page_size}' if offset + state.page_size < len(advisors) else None
+            return (200, {'entitlements': page, 'pagination': {'next': next_page}})
+
+        if path == '/pod/v2/admin/user/list' and method == 'GET':
+            self.record(method, path)
+            skip = int(query.get('skip', ['0'])[0])
+            limit = int(query.get('limit', ['50'])[0])
+            users = [{'userSystemInfo': {'id': state.first_id + index, 'status': 'ENABLED'},
+                      'userAttributes': {'emailAddress': f'user{index}@example.com', 'userName': f'user{index}'}}
+                     for index in range(skip, min(state.user_count, skip + limit))]
+            return (200, users)
+
+        match = USER_APPS.match(path)
+        if match:
+            self.record(method, '/pod/v1/admin/user/{id}/app/entitlement/list')
+            if method == 'GET':
+                installed = state.installed.get(match.group(1), False)
+                return (200, [{'appId': state.app_id, 'appName': 'Connect', 'listed': True, 'install': installed}])
+            if method == 'POST':
+                for app in body:
+                    if app['appId'] == state.app_id:
+                        state.installed[match.group(1)] = app['install']
+                return (200, body)
+
+        return problem(404, f'No mock route for {method} {path}')
+
+
+    def record(self, method, template):
+        key = f'{method} {template}'
+        self.server.state.calls[key] = self.server.state.calls.get(key, 0) + 1
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, state, cert_file, key_file, host='127.0.0.1', port=0, latency_ms=0, jitter=0.2, throttle_rate=0):
+        super().__init__((host, port), MockRequestHandler)
+        self.state = state
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_file, key_file)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def generate_key(path):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with open(path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM,
+                                  serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return key
+
+
+def generate_certificate(directory, host='localhost'):
+    """Create a self-signed certificate for host, returns (cert_file, key_file)"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.x509.oid import NameOID
+
+    key_file = os.path.join(directory, 'mock-server-key.pem')
+    cert_file = os.path.join(directory, 'mock-server-cert.pem')
+    key = generate_key(key_file)
+
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(name)
+                   .issuer_name(name)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(days=1))
+                   .not_valid_after(now + datetime.timedelta(days=7))
+                   .add_extension(x509.SubjectAlternativeName([x509.DNSName(host)]), critical=False)
+                   .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                   .sign(key, hashes.SHA256()))
+    with open(cert_file, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+
+    return cert_file, key_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock CES / pod API server')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--roster-size', type=int, default=0)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--cert-dir', default='.')
+    args = parser.parse_args()
+
+    cert_file, key_file = generate_certificate(args.cert_dir)
+    server = MockServer(MockState(roster_size=args.roster_size, user_count=args.users), cert_file, key_file,
+                        port=args.port, latency_ms=args.latency_ms, throttle_rate=args.throttle_rate)
+    print(f'Mock server listening on https://localhost:{server.server_address[1]} - certificate: {cert_file}')
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
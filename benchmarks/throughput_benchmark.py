@@ -0,0 +1,208 @@
+"""End-to-end throughput benchmark of main.py against the local mock server.
+
+For every input size a synthetic CSV is generated, the real pipeline (main.main) runs in a fresh
+process against benchmarks/mock_server.py, and the following are reported:
+rows/sec, API calls per row, p50 / p99 call latency as seen by the client and peak memory.
+Client latencies are measured on requests sessions, so calls sent by the async transport are not included.
+
+Usage:
+    python3 benchmarks/throughput_benchmark.py --rows 100,1000,10000 --concurrency 8 --latency-ms 20
+
+Unknown flags are passed through to main.py, e.g. ``--reconcile``.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from mock_server import MockServer, MockState, PERMISSIONS, generate_certificate, generate_key
+
+FIRST_ID = 100000000000000
+APP_ID = 'com.symphony.sfs.admin-app'
+
+
+def build_workspace(directory, port, cert_file, rows, roster_size, app_id, seed=1):
+    """Create resources/, rsa/ and a synthetic input CSV in directory"""
+    os.makedirs(os.path.join(directory, 'resources'))
+    os.makedirs(os.path.join(directory, 'rsa'))
+    generate_key(os.path.join(directory, 'rsa', 'privateKey.pem'))
+    generate_key(os.path.join(directory, 'rsa', 'bot-private-key.pem'))
+
+    config = {
+        'apiURL': 'localhost',
+        'sessionAuthPort': port,
+        'privateKeyPath': './rsa/',
+        'privateKeyName': 'privateKey.pem',
+        'publicKeyId': 'benchmark',
+        'entitlementType': 'WHATSAPP',
+        'appId': app_id,
+        'proxyURL': '',
+        'proxyUsername': '',
+        'proxyPassword': '',
+        'truststorePath': cert_file,
+        'userDirectoryCacheTTL': 0
+    }
+    with open(os.path.join(directory, 'resources', 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+
+    symphony_config = {
+        'sessionAuthHost': 'localhost', 'sessionAuthPort': port,
+        'keyAuthHost': 'localhost', 'keyAuthPort': port,
+        'podHost': 'localhost', 'podPort': port,
+        'agentHost': 'localhost', 'agentPort': port,
+        'authType': 'rsa',
+        'botPrivateKeyPath': './rsa/', 'botPrivateKeyName': 'bot-private-key.pem',
+        'botCertPath': '', 'botCertName': '', 'botCertPassword': '',
+        'botUsername': 'benchmark', 'botEmailAddress': 'benchmark@example.com',
+        'appCertPath': '', 'appCertName': '', 'appCertPassword': '',
+        'authTokenRefreshPeriod': '30',
+        'proxyURL': '', 'proxyUsername': '', 'proxyPassword': '',
+        'podProxyURL': '', 'podProxyUsername': '', 'podProxyPassword': '',
+        'agentProxyURL': '', 'agentProxyUsername': '', 'agentProxyPassword': '',
+        'keyManagerProxyURL': '', 'keyManagerProxyUsername': '', 'keyManagerProxyPassword': '',
+        'truststorePath': cert_file
+    }
+    with open(os.path.join(directory, 'resources', 'symphony_config.json'), 'w') as f:
+        json.dump(symphony_config, f, indent=2)
+
+    # Mostly ADD rows, some of them for advisors already in the roster, and a few REMOVE rows
+    generator = random.Random(seed)
+    with open(os.path.join(directory, 'whatsapp_user_entitlements.csv'), 'w', newline='') as f:
+        f.write('advisorSymphonyId,Action,Permissions\n')
+        for index in range(rows):
+            action = 'REMOVE' if generator.random() < 0.15 else 'ADD'
+            permissions = '~'.join(generator.sample(PERMISSIONS, generator.randint(1, 3))) if action == 'ADD' else ''
+            f.write(f'{FIRST_ID + index},{action},{permissions}\n')
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_pipeline(workspace, main_args):
+    """Run main.main() in this process and write its metrics to workspace/metrics.json"""
+    import requests
+
+    latencies = []
+    original_request = requests.Session.request
+
+    def timed_request(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original_request(self, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    requests.Session.request = timed_request
+
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(workspace)
+    import main
+
+    sys.argv = ['main.py'] + main_args
+    log_path = os.path.join(workspace, 'main.log')
+    with open(log_path, 'w') as log:
+        stdout = sys.stdout
+        sys.stdout = log
+        try:
+            start = time.perf_counter()
+            main.main()
+            elapsed = time.perf_counter() - start
+        finally:
+            sys.stdout = stdout
+
+    metrics = {
+        'elapsed': elapsed,
+        'client_calls': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+    with open(os.path.join(workspace, 'metrics.json'), 'w') as f:
+        json.dump(metrics, f)
+
+
+def run_size(rows, args, main_args, cert_file, key_file, temp_dir):
+    roster_size = int(rows * args.roster_fraction)
+    state = MockState(roster_size=roster_size, user_count=args.users, first_id=FIRST_ID, app_id=APP_ID)
+    server = MockServer(state, cert_file, key_file, host='localhost', latency_ms=args.latency_ms,
+                        throttle_rate=args.throttle_rate)
+    server.start()
+
+    workspace = tempfile.mkdtemp(prefix=f'rows-{rows}-', dir=temp_dir)
+    build_workspace(workspace, server.server_address[1], cert_file, rows, roster_size,
+                    '' if args.no_app else APP_ID)
+
+    command = [sys.executable, os.path.abspath(__file__), '--run-pipeline', workspace, '--'] + main_args
+    # requests lets these variables override session.verify, which would ignore the truststorePath
+    env = {name: value for name, value in os.environ.items() if name not in ('REQUESTS_CA_BUNDLE', 'CURL_CA_BUNDLE')}
+    # Worker processes (--processes) write to the inherited stdout, keep it out of the results table
+    with open(os.path.join(workspace, 'workers.log'), 'w') as log:
+        subprocess.run(command, check=True, env=env, stdout=log)
+    server.shutdown()
+    server.server_close()
+
+    with open(os.path.join(workspace, 'metrics.json')) as f:
+        metrics = json.load(f)
+    stats = state.stats()
+    metrics.update({
+        'rows': rows,
+        'rows_per_sec': rows / metrics['elapsed'] if metrics['elapsed'] > 0 else 0.0,
+        'calls_per_row': stats['total_calls'] / rows if rows > 0 else 0.0,
+        'throttled': stats['calls'].get('GET throttled', 0) + stats['calls'].get('POST throttled', 0)
+                     + stats['calls'].get('DELETE throttled', 0),
+        'server_calls': stats['calls']
+    })
+    return metrics
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--run-pipeline':
+        run_pipeline(sys.argv[2], sys.argv[4:])
+        return
+
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmark against the local mock server')
+    parser.add_argument('--rows', default='100,1000', help='Comma separated input sizes')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--roster-fraction', type=float, default=0.2,
+                        help='Fraction of the input advisors already entitled before the run')
+    parser.add_argument('--users', type=int, default=1000, help='Number of pod users')
+    parser.add_argument('--no-app', action='store_true', help='Run without extension app management')
+    parser.add_argument('--json', default=None, help='Also write the results to this file')
+    args, main_args = parser.parse_known_args()
+    main_args = ['--concurrency', str(args.concurrency)] + main_args
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cert_file, key_file = generate_certificate(temp_dir)
+
+        print(f"{'rows':>8} {'seconds':>9} {'rows/sec':>9} {'calls/row':>10} {'p50 ms':>8} {'p99 ms':>8} "
+              f"{'peak MB':>8} {'429s':>6}")
+        for rows in [int(value) for value in args.rows.split(',')]:
+            metrics = run_size(rows, args, main_args, cert_file, key_file, temp_dir)
+            results.append(metrics)
+            print(f"{rows:>8} {metrics['elapsed']:>9.2f} {metrics['rows_per_sec']:>9.1f} "
+                  f"{metrics['calls_per_row']:>10.2f} {metrics['p50_ms']:>8.1f} {metrics['p99_ms']:>8.1f} "
+                  f"{metrics['peak_memory_mb']:>8.1f} {metrics['throttled']:>6}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
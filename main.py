@@ -1,168 +1,1004 @@
-import csv, sys, traceback
+import time
+# Start of the script - used to measure startup time, see main
+STARTED = time.perf_counter()
+import argparse, csv, itertools, os, sys, traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from modules.rsa_auth import SymBotRSAAuth
 from modules.configure import SymConfig
 from modules.entitlement_client import EntitlementClient
-from modules.pod_user_client import PodUserClient
+from modules.inbox_watcher import InboxWatcher, read_paths, POLL_SECONDS
+from modules.permission_audit import export_permissions
+from modules.pod_user_client import PodUserClient, USER_CACHE_FILE, USER_CACHE_TTL
+from modules.row_executor import (run_ordered, run_ordered_async, run_sharded, drive_steps, drive_steps_async,
+                                  EventLoopThread)
+from modules.roster_index import RosterIndex, NO_OP
+from modules.result_journal import ResultJournal
+from modules.row_planner import coalesce_rows, drain, expand_plans, plan_rows, planned_actions
+from modules.row_record import (read_rows, render_status, ENTITLEMENT_ADDED, ENTITLEMENT_REMOVED,
+                                ENTITLEMENT_UNCHANGED, ENTITLEMENT_REJECTED, ENTITLEMENT_FAILED, APP_UPDATED,
+                                APP_UNCHANGED, APP_FAILED, APP_KEPT, PERMISSION_UNKNOWN, PERMISSION_HELD, PERMISSION_ADDED,
+                                PERMISSION_REJECTED, PERMISSION_NOT_ADDED, PERMISSION_ADD_FAILED, PERMISSION_REVOKED,
+                                PERMISSION_REVOKE_FAILED, ENTITLEMENT_DEFERRED, PERMISSION_DEFERRED,
+                                ENTITLEMENT_INVALID_NETWORK, is_deferred)
+from modules.metrics import run_metrics
+from modules.throttling import SharedTokenBucketRateLimiter, DeferredCallError
 
 # Input/Output File Names
 INPUT_FILE = 'whatsapp_user_entitlements.csv'
 OUTPUT_FILE = 'whatsapp_user_entitlements_output.csv'
 USER_FILE = 'current_user_list.csv'
+JOURNAL_FILE = 'whatsapp_user_entitlements_output.journal'
+RUN_REPORT_FILE = 'whatsapp_user_entitlements_run_report.json'
+
+# Number of rows whose extension app changes are sent together
+APP_BATCH_SIZE = 50
+
+# Oldest Python the async transport (aiohttp, async generators on an event loop thread) is tested with
+ASYNC_MIN_PYTHON = (3, 7)
+
+# Watch mode - folders of the inbox receiving processed files, and the age at which a roster is reloaded
+WATCH_DONE_DIR = 'done'
+WATCH_FAILED_DIR = 'failed'
+ROSTER_REFRESH_SECONDS = 3600
+
+# State of a shard worker process, see init_shard
+shard_state = dict()
+
+IMPORT_SECONDS = time.perf_counter() - STARTED
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Add / remove users to Symphony Connect entitlements')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Number of advisors processed in parallel (overrides "concurrency" in config.json)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Split the advisors across N worker processes, each running --concurrency workers '
+                             '(overrides "processes" in config.json)')
+    parser.add_argument('--transport', choices=('sync', 'async'), default=None,
+                        help='Send the row API calls from a thread pool (sync) or an asyncio event loop (async) '
+                             '(overrides "transport" in config.json)')
+    parser.add_argument('--reconcile', action='store_true', default=None,
+                        help='Compare rows against the current roster and only issue the required changes')
+    parser.add_argument('--revoke-permissions', action='store_true', default=None,
+                        help='Revoke permissions an advisor holds that are not listed in the row')
+    parser.add_argument('--deadline', type=float, default=None, metavar='SECONDS',
+                        help='Stop sending API calls SECONDS after the rows start processing - the remaining rows '
+                             'are reported as DEFERRED and picked up by --resume (overrides "runDeadlineSeconds" '
+                             'in config.json)')
+    parser.add_argument('--resume', action='store_true',
+                        help=f'Skip rows already completed by a previous run (recorded in {JOURNAL_FILE})')
+    parser.add_argument('--watch', default=None, metavar='DIR',
+                        help='Keep running and process every CSV file dropped into DIR, or every file path '
+                             'read from stdin when DIR is "-"')
+    parser.add_argument('--export-permissions', default=None, metavar='PATH',
+                        help='Export the permissions of every entitled advisor to PATH (.csv or .jsonl) instead of '
+                             'processing the input file - with --resume, continue an interrupted export')
+    parser.add_argument('--prometheus-textfile', default=None, metavar='PATH',
+                        help='Also write the run metrics to PATH in the Prometheus textfile collector format')
+    return parser.parse_args(argv)
 
 
 def main():
+    args = parse_args()
     print('Start Processing...')
+    run_metrics.record_phase('imports', IMPORT_SECONDS)
+    phase_start = time.perf_counter()
 
     # RSA Auth flow: pass path to rsa config.json file
     configure = SymConfig('./resources/config.json')
     configure.load_config()
-    entitlement_type = configure.data["entitlementType"]
-    auth = SymBotRSAAuth(configure)
-    entitlement_client = EntitlementClient(auth, configure, entitlement_type)
-    if configure.data["appId"] != '':
-        pod_user_client = PodUserClient(configure.data["appId"])
+    if args.concurrency is not None:
+        configure.data['concurrency'] = args.concurrency
+    if args.processes is not None:
+        configure.data['processes'] = args.processes
+    if args.transport is not None:
+        configure.data['transport'] = args.transport
+    if args.reconcile is not None:
+        configure.data['reconcile'] = args.reconcile
+    if args.revoke_permissions is not None:
+        configure.data['revokePermissions'] = args.revoke_permissions
+    if args.deadline is not None:
+        configure.data['runDeadlineSeconds'] = args.deadline
+    if args.prometheus_textfile is not None:
+        configure.data['prometheusTextfile'] = args.prometheus_textfile
+    prometheus_textfile = configure.data.get('prometheusTextfile', '')
+
+    runner = BatchRunner(configure, watch=args.watch is not None)
+    record_phase('config', phase_start)
+
+    try:
+        if args.export_permissions is not None:
+            export_roster_permissions(runner, args.export_permissions, args.resume)
+        elif args.watch is not None:
+            watch_files(runner, args.watch, prometheus_textfile)
+        else:
+            runner.run_file(INPUT_FILE, OUTPUT_FILE, USER_FILE, JOURNAL_FILE, resume=args.resume, started=STARTED)
+    finally:
+        runner.close()
+        # Run report - call counts, status codes and latencies per endpoint, also written when the run fails
+        write_run_report(runner, prometheus_textfile)
+
+
+class BatchRunner():
+    """Clients, rosters and worker pools shared by the input files of a run.
+
+    A normal run processes a single file. In watch mode every new file goes through the same runner,
+    so authentication, connection pools, the pod user directory and the rosters are set up only once.
+
+    With "transport": "async" the rows are processed by coroutines on an event loop thread (see
+    process_plans_async), the roster, user list and audit calls stay on the synchronous client.
+    """
+
+    def __init__(self, configure, watch=False):
+        self.configure = configure
+        self.watch = watch
+        self.app_id = configure.data["appId"]
+        self.entitlement_type = configure.data["entitlementType"]
+        self.concurrency = max(1, int(configure.data.get('concurrency', 1)))
+        self.processes = max(1, int(configure.data.get('processes', 1)))
+        self.reconcile = configure.data.get('reconcile', False)
+        self.roster_refresh_seconds = float(configure.data.get('rosterRefreshSeconds', ROSTER_REFRESH_SECONDS))
+
+        self.transport = configure.data.get('transport', 'sync')
+        if self.transport not in ('sync', 'async'):
+            raise Exception(f'Invalid transport {self.transport} - expected sync or async')
+        if self.transport == 'async' and sys.version_info < ASYNC_MIN_PYTHON:
+            raise Exception(f'The async transport requires Python {".".join(map(str, ASYNC_MIN_PYTHON))} or above')
+        if self.transport == 'async' and self.processes > 1:
+            print('The async transport runs in a single process - ignoring processes')
+            self.processes = 1
+
+        auth = SymBotRSAAuth(configure)
+        self.entitlement_client = EntitlementClient(auth, configure, self.entitlement_type)
+        pod_client_class = PodUserClient
+        if self.transport == 'async':
+            # aiohttp is only imported by async runs - it would double the startup time of the others
+            from modules.async_entitlement_client import AsyncEntitlementClient
+            from modules.pod_user_client import AsyncPodUserClient
+            pod_client_class = AsyncPodUserClient
+        if self.app_id != '':
+            self.pod_user_client = pod_client_class(self.app_id,
+                                                    cache_path=configure.data.get('userDirectoryCacheFile', USER_CACHE_FILE),
+                                                    cache_ttl=int(configure.data.get('userDirectoryCacheTTL', USER_CACHE_TTL)),
+                                                    workers=self.concurrency)
+        else:
+            self.pod_user_client = None
+
+        # The async client shares the JWT cache, requestsPerSecond budget, deadline and circuit breakers
+        # of the synchronous one
+        self.event_loop = None
+        self.async_client = None
+        if self.transport == 'async':
+            self.event_loop = EventLoopThread()
+            self.async_client = AsyncEntitlementClient(auth, configure, self.entitlement_type)
+            self.async_client.rate_limiter = self.entitlement_client.rate_limiter
+            self.async_client.deadline = self.entitlement_client.deadline
+            self.async_client.circuit_breakers = self.entitlement_client.circuit_breakers
+
+        # One client per network - all of them share the JWT cache, session and limiters
+        self.clients = dict()
+        # Roster of each network and when it was loaded, see load_rosters
+        self.rosters = dict()
+        self.roster_loaded = dict()
+        # Independent steps of a row (permission grants...) run on their own pool, see process_row
+        self.step_executor = create_step_executor(self.concurrency) if self.transport == 'sync' else None
+
+
+    def client(self, network):
+        if network not in self.clients:
+            self.clients[network] = self.entitlement_client.for_network(network)
+        return self.clients[network]
+
+
+    def close(self):
+        if self.step_executor is not None:
+            self.step_executor.shutdown()
+        if self.event_loop is not None:
+            self.event_loop.run(self.close_async())
+            self.event_loop.close()
+
+
+    async def close_async(self):
+        await self.async_client.close()
+        if self.pod_user_client is not None:
+            await self.pod_user_client.close()
+
+
+    def record_connections(self):
+        run_metrics.record_connections('ces', *self.entitlement_client.connection_stats())
+        if self.async_client is not None:
+            run_metrics.record_connections('ces_async', *self.async_client.connection_stats())
+
+
+    async def process_plans_async(self, plans, rosters, check_app=False, run_actions=None):
+        """Async row loop - process the plans as coroutines and apply their extension app changes.
+
+        Up to concurrency * 2 plans are in progress at a time and yielded in order; the API calls in
+        flight are bounded by the clients.
+        """
+        configure = self.configure
+        clients = {network: self.async_client.for_network(network) for network in self.clients}
+        keeps_app = None
+        if run_actions is not None:
+            keeps_app = partial(stays_entitled, clients, self.rosters, run_actions)
+
+        async def process(plan):
+            if plan.resumed:
+                return plan
+
+            return await process_row_async(plan, clients.get(plan.network), configure.data["appId"],
+                                           rosters.get(plan.network), configure.data.get('revokePermissions', False),
+                                           check_app)
+
+        results = run_ordered_async(process, plans, self.concurrency * 2)
+        if self.pod_user_client is not None:
+            app_batch_size = max(1, int(configure.data.get('appBatchSize', APP_BATCH_SIZE)))
+            results = apply_app_changes_async(results, self.pod_user_client, configure.data["appId"], app_batch_size,
+                                              keeps_app)
+        async for plan in results:
+            yield plan
+
+
+    def load_rosters(self, networks):
+        """Load the rosters not loaded yet, and in watch mode the ones older than rosterRefreshSeconds"""
+        now = time.time()
+        stale = [network for network in networks if network not in self.rosters or
+                 (self.watch and 0 < self.roster_refresh_seconds < now - self.roster_loaded[network])]
+        if len(stale) == 0:
+            return
+
+        mode = 'Reconcile mode - ' if self.reconcile else ''
+        print(f'{mode}Loading current entitlement roster for {", ".join(stale)}...')
+        def load_roster(network):
+            return RosterIndex(self.clients[network].iter_entitlements())
+
+        for network, roster in zip(stale, run_ordered(load_roster, stale, self.concurrency)):
+            self.rosters[network] = roster
+            self.roster_loaded[network] = now
+            print(f'{len(roster)} advisor(s) currently entitled to {network}')
+
+
+    def run_file(self, input_file, output_file, user_file, journal_file, resume=False, started=None):
+        """Process one input file, returns the number of rows deferred to a resumed run"""
+        phase_start = time.perf_counter()
+        started = started if started is not None else phase_start
+        configure = self.configure
+
+        # Rows for the same advisor are merged into one operation, every original row still gets a status
+        with open(input_file, newline='') as csvfile:
+            plans, records = coalesce_rows(read_rows(csvfile, self.entitlement_type))
+        print(f'{len(records)} row(s) planned as {len(plans)} operation(s)')
+        phase_start = record_phase('plan', phase_start)
+
+        # Rows with an invalid Network are reported as skipped, no client or roster is created for them
+        input_networks = list(dict.fromkeys(r.network for r in records
+                                            if r.entitlement != ENTITLEMENT_INVALID_NETWORK))
+        networks = list(dict.fromkeys([self.entitlement_type] + input_networks))
+        clients = {network: self.client(network) for network in networks}
+
+        # Reconcile mode fetches the roster once per network and only issues the writes that are needed.
+        # Watch mode keeps the rosters up to date with every file and writes the user list from them.
+        if self.reconcile or self.watch:
+            self.load_rosters(networks if self.watch else input_networks)
+            phase_start = record_phase('roster', phase_start)
+        rosters = self.rosters if self.reconcile else dict()
+
+        # The extension app is per user - a REMOVE keeps it while the user stays entitled to another network
+        run_actions = None
+        if self.pod_user_client is not None and len(networks) > 1:
+            run_actions = planned_actions(plans)
+
+        # Completed rows are journaled so an interrupted run can be resumed
+        journal = ResultJournal(journal_file, resume=resume)
+        if resume:
+            resume_plans(plans, journal)
+        print(f'Started in {time.perf_counter() - started:.2f}s')
+
+        # The run deadline covers the rows - calls not sent in time are deferred, see is_deferred
+        deadline = self.entitlement_client.deadline
+        deadline.start()
+        deferred_rows = []
+
+        step_executor = self.step_executor
+        def process(plan):
+            if plan.resumed:
+                return plan
+
+            # A resumed run re-checks the app of advisors already entitled - the interrupted run may have
+            # stopped before sending it
+            return process_row(plan, clients.get(plan.network), configure.data["appId"],
+                               rosters.get(plan.network), configure.data.get('revokePermissions', False), step_executor,
+                               resume)
+
+        # Now process CSV file
+        # Independent advisors (and networks) are processed in parallel, results are written in input order
+        try:
+            if self.event_loop is not None:
+                print(f'Processing rows with up to {self.concurrency} API call(s) in flight - '
+                      f'writing results to {output_file}')
+                results = self.event_loop.iterate(self.process_plans_async(drain(plans), rosters, resume,
+                                                                          run_actions))
+            elif self.processes > 1:
+                print(f'Processing rows with {self.processes} process(es) of {self.concurrency} worker(s) - '
+                      f'writing results to {output_file}')
+                results = run_plans_sharded(plans, self.processes, self.concurrency, configure, rosters, deadline,
+                                            resume)
+            else:
+                print(f'Processing rows with {self.concurrency} worker(s) - writing results to {output_file}')
+                results = run_ordered(process, drain(plans), self.concurrency)
+            if self.pod_user_client is not None and self.event_loop is None:
+                app_batch_size = max(1, int(configure.data.get('appBatchSize', APP_BATCH_SIZE)))
+                keeps_app = None
+                if run_actions is not None:
+                    keeps_app = partial(stays_entitled, clients, self.rosters, run_actions)
+                results = apply_app_changes(results, self.pod_user_client, configure.data["appId"], app_batch_size,
+                                            keeps_app)
+            if self.watch:
+                results = track_rosters(results, self.rosters)
+            include_network = any(r.network_column for r in records)
+            rows = render_results(expand_plans(results, records), configure.data["appId"])
+            print_result(journal_results(rows, journal, deferred_rows), include_network, output_file)
+        finally:
+            journal.close()
+            deadline.stop()
+
+        if len(deferred_rows) > 0:
+            print(f'{len(deferred_rows)} row(s) deferred - rerun with --resume to process them')
+
+        # Print Current User List - one file covering every network of the run
+        print(f'Generating Current User List...')
+        if self.watch:
+            entitlements = itertools.chain.from_iterable(self.rosters[network].entries() for network in networks)
+        else:
+            entitlements = itertools.chain.from_iterable(clients[network].iter_entitlements() for network in networks)
+        try:
+            print_curent_user_list(entitlements, user_file)
+        except DeferredCallError as ex:
+            # The rows are already written - an unavailable API only costs the user list
+            print(f'Unable to generate the Current User List - {ex}')
+            if os.path.exists(user_file):
+                os.remove(user_file)
+        return len(deferred_rows)
+
+
+def export_roster_permissions(runner, path, resume=False):
+    """Permission audit of the roster of entitlementType, or of every network listed in auditNetworks"""
+    networks = runner.configure.data.get('auditNetworks') or [runner.entitlement_type]
+    print(f'Exporting the permissions of every advisor entitled to {", ".join(networks)} to {path}')
+    # The run deadline covers the export - advisors not read in time are left to --resume
+    deadline = runner.entitlement_client.deadline
+    deadline.start()
+    try:
+        exported = export_permissions([runner.client(network) for network in networks], path, runner.concurrency,
+                                      resume)
+    finally:
+        deadline.stop()
+    print(f'{exported} advisor(s) exported to {path}')
+
+
+def watch_files(runner, source, prometheus_textfile=''):
+    """Process every CSV file dropped into the source directory, or listed on stdin when source is '-'.
+
+    Files from the inbox are moved to its done/ (or failed/) folder together with their output and
+    user list; files listed on stdin get them next to the input file. A file interrupted by a crash
+    is resumed from its journal the next time it is processed, and so is a file with deferred rows.
+    """
+    if source == '-':
+        print('Watch mode - reading input file paths from stdin')
+        paths = read_paths(sys.stdin)
     else:
-        pod_user_client = None
-
-    # Now process CSV file
-    # CSV file will have 2 columns - advisorSymphonyId, Action, Permission (ADD / REMOVE)
-    process_result = []
-    with open(INPUT_FILE, newline='') as csvfile:
-        csv_list = csv.reader(csvfile, delimiter=',')
-        for row in csv_list:
-            # Ignore blank rows
-            if len(row) == 0:
-                continue
+        print(f'Watch mode - waiting for CSV files in {source}')
+        for folder in (WATCH_DONE_DIR, WATCH_FAILED_DIR):
+            os.makedirs(os.path.join(source, folder), exist_ok=True)
+        paths = InboxWatcher(source, float(runner.configure.data.get('watchPollSeconds', POLL_SECONDS)))
 
-            # Ensure CSV has 3 columns
-            if len(row) !=3 :
-                raise Exception(
-                    'Invalid CSV File Format - Expect 3 columns - advisorSymphonyId, Action, Permissions')
+    try:
+        for input_file in paths:
+            started = time.perf_counter()
+            stem = os.path.splitext(input_file)[0]
+            journal_file = stem + '_output.journal'
+            if source == '-':
+                target = stem
+            else:
+                # Timestamped, so a file dropped again with the same name never overwrites earlier results
+                target = os.path.join(source, WATCH_DONE_DIR,
+                                      time.strftime('%Y%m%d-%H%M%S_') + os.path.basename(stem))
 
-            # Skip header row
-            if row[0] == "advisorSymphonyId":
+            print(f'Processing {input_file}')
+            try:
+                deferred = runner.run_file(input_file, target + '_output.csv', target + '_user_list.csv', journal_file,
+                                resume=os.path.exists(journal_file), started=started)
+            except Exception as ex:
+                exInfo = sys.exc_info()
+                print(f" ##### ERROR WHILE PROCESSING {input_file} #####")
+                print('Stack Trace: ' + ''.join(traceback.format_exception(exInfo[0], exInfo[1], exInfo[2])))
+                # The journal is kept - the completed rows are skipped if the file is dropped again
+                if source != '-' and os.path.exists(input_file):
+                    os.replace(input_file, os.path.join(source, WATCH_FAILED_DIR, os.path.basename(input_file)))
                 continue
 
-            result_record = dict()
-            # Get row values
-            result_record['result'] = ''
-            result_record['advisorSymphonyId'] = row[0].lower()
-            result_record['ent_action'] = row[1].upper()
-            result_record['permission'] = row[2]
-
-            # Check if valid Entitlement Action
-            if result_record['ent_action'] not in ("ADD", "REMOVE", ""):
-                result_record['result'] = 'ERROR - Invalid Entitlement Action - SKIPPED'
-                process_result.append(result_record)
+            if deferred > 0:
+                # Like a failed file, with the journal kept so only the deferred rows are sent again
+                print(f'{input_file} has {deferred} deferred row(s) - drop it again to process them')
+                if source != '-':
+                    os.replace(input_file, os.path.join(source, WATCH_FAILED_DIR, os.path.basename(input_file)))
+                write_run_report(runner, prometheus_textfile, print_summary=False)
                 continue
 
-            # If advisorSymphonyId is blank, then SKIP
-            if result_record['advisorSymphonyId'] is None or result_record['advisorSymphonyId'] == '':
-                result_record['result'] = f'ERROR - advisorSymphonyId field is not populated - SKIPPED'
-                process_result.append(result_record)
-                continue
+            os.remove(journal_file)
+            if source != '-':
+                os.replace(input_file, target + os.path.splitext(input_file)[1])
+            print(f'{input_file} processed in {time.perf_counter() - started:.2f}s - results in {target}_output.csv')
+            write_run_report(runner, prometheus_textfile, print_summary=False)
+
+    except KeyboardInterrupt:
+        print('Watch mode stopped')
+
+
+def record_phase(name, phase_start):
+    """Record the duration of a startup step and return the start of the next one"""
+    now = time.perf_counter()
+    run_metrics.record_phase(name, now - phase_start)
+    return now
+
+
+def create_step_executor(concurrency):
+    # API calls stay capped at concurrency by EntitlementClient - the extra threads only wait on it
+    if concurrency <= 1:
+        return None
+    return ThreadPoolExecutor(max_workers=concurrency * 2)
+
+
+def resume_plans(plans, journal):
+    """Mark the plans whose rows were all completed by the previous run, copying their journaled results"""
+    for plan in plans:
+        rows = plan_rows(plan)
+        previous_results = [journal.lookup(r.row_number, r.row_hash) for r in rows]
+        if None not in previous_results:
+            for record, previous_result in zip(rows, previous_results):
+                record.resumed_status = previous_result
+                record.resumed = True
+            plan.resumed = True
+
+
+def run_plans_sharded(plans, processes, concurrency, configure, rosters, deadline, check_app=False):
+    """Process the plans in worker processes, sharded by advisor, and yield them in input order.
+
+    Each worker has its own CES session and circuit breakers; all of them draw from one
+    requestsPerSecond budget and stop at the same run deadline.
+    Extension app changes are applied afterwards by this process, see apply_app_changes.
+    """
+    rate_limiter = SharedTokenBucketRateLimiter(float(configure.data.get('requestsPerSecond', 0)))
+    roster_entries = {network: roster.entries() for network, roster in rosters.items()}
+
+    # The rows behind each plan stay in this process
+    work = [plan.detached() for plan in plans]
+    for plan, result in zip(drain(plans), run_sharded(process_shard_plan, work, processes, plan_shard_key,
+                                               threads=concurrency, initializer=init_shard,
+                                               initargs=(configure, roster_entries, rate_limiter, deadline, check_app),
+                                               finalizer=finish_shard)):
+        plan.copy_outcome(result)
+        yield plan
+
+
+def plan_shard_key(plan):
+    return plan.network, RosterIndex.normalize_id(plan.advisor_id)
+
+
+def init_shard(configure, roster_entries, rate_limiter, deadline, check_app):
+    auth = SymBotRSAAuth(configure)
+    entitlement_client = EntitlementClient(auth, configure, configure.data["entitlementType"])
+    entitlement_client.rate_limiter = rate_limiter
+    entitlement_client.deadline = deadline
+    shard_state['entitlement_client'] = entitlement_client
+    shard_state['rosters'] = {network: RosterIndex(entries) for network, entries in roster_entries.items()}
+    shard_state['configure'] = configure
+    shard_state['step_executor'] = create_step_executor(int(configure.data.get('concurrency', 1)))
+    shard_state['check_app'] = check_app
+
+
+def process_shard_plan(plan):
+    if plan.resumed:
+        return plan
+
+    configure = shard_state['configure']
+    return process_row(plan, shard_state['entitlement_client'].for_network(plan.network), configure.data["appId"],
+                       shard_state['rosters'].get(plan.network), configure.data.get('revokePermissions', False),
+                       shard_state['step_executor'], shard_state['check_app'])
+
+
+def finish_shard():
+    run_metrics.record_connections('ces', *shard_state['entitlement_client'].connection_stats())
+
+
+def status_summary_key(row):
+    """Summary category of a row, built from its structured outcome"""
+    if row.resumed:
+        return 'RESUMED'
+
+    plan = row.plan if row.plan is not None else row
+    if is_deferred(plan):
+        return f'{plan.action} DEFERRED'
+    key = f'{plan.action or "-"} {plan.entitlement or "-"}'
+    if plan.entitlement == ENTITLEMENT_REJECTED:
+        key += f' ({plan.entitlement_detail})'
+    if plan.app is not None:
+        key += f' / app {plan.app}'
+    failed = (PERMISSION_UNKNOWN, PERMISSION_REJECTED, PERMISSION_NOT_ADDED, PERMISSION_ADD_FAILED,
+              PERMISSION_REVOKE_FAILED)
+    if any(outcome in failed for outcome, name, detail in plan.permissions or ()):
+        key += ' / permission errors'
+    if plan is not row and row is not plan.rows[-1]:
+        key = 'merged: ' + key
+    return key
+
+
+def write_run_report(runner, prometheus_textfile='', print_summary=True):
+    runner.record_connections()
+    run_metrics.write_json(RUN_REPORT_FILE)
+    if prometheus_textfile:
+        run_metrics.write_prometheus(prometheus_textfile)
+    if not print_summary:
+        return
+
+    summary = run_metrics.summary()
+    print(f"Processed {summary['rows']} row(s) in {summary['elapsed_seconds']:.1f}s "
+          f"({summary['rows_per_second']:.1f} rows/s) - {summary['calls']} API call(s), "
+          f"{summary['retries']} retried, {summary['jwt_mints']} JWT(s) signed")
+    print('Startup: ' + ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in summary['phase_seconds'].items()))
+    print('Rows per status:')
+    for status, count in summary['row_statuses'].items():
+        print(f'  {count:>7}  {status}')
+    for endpoint in summary['endpoints']:
+        latency = endpoint['latency_seconds']
+        print(f"  {endpoint['client']} {endpoint['method']} {endpoint['endpoint']}: {endpoint['calls']} call(s) "
+              f"p50 {latency['p50'] * 1000:.0f}ms p99 {latency['p99'] * 1000:.0f}ms {endpoint['status_codes']}")
+    print(f'Run report written to {RUN_REPORT_FILE}')
+
+
+def process_row(result_record, entitlement_client, app_id, roster=None, revoke_permissions=False, step_executor=None,
+                check_app=False):
+    """Apply one planned row.
+
+    Steps run in dependency order: the entitlement is created first, then - with a step_executor - all
+    permission grants and revokes are sent concurrently. The extension app change only depends on the
+    entitlement and is applied in batches while later rows are processed, see apply_app_changes.
+    """
+    return drive_steps(row_steps(result_record, entitlement_client, app_id, roster, revoke_permissions, check_app),
+                       step_executor)
+
+
+async def process_row_async(result_record, entitlement_client, app_id, roster=None, revoke_permissions=False,
+                            check_app=False):
+    """process_row for the async transport - the same steps, awaited on an AsyncEntitlementClient"""
+    return await drive_steps_async(row_steps(result_record, entitlement_client, app_id, roster, revoke_permissions,
+                                             check_app))
+
+
+def row_steps(result_record, entitlement_client, app_id, roster=None, revoke_permissions=False, check_app=False):
+    """Steps of one planned row, shared by both transports.
+
+    A step generator (see row_executor.drive_steps): every API call is yielded as a callable and its
+    result sent back, so the same logic runs on EntitlementClient and AsyncEntitlementClient.
+    With check_app (resumed runs), ADD rows for advisors already entitled - skipped in reconcile mode or
+    rejected with a 409 - still get their extension app checked.
+    """
+    # Rows that failed validation (see read_rows) are not sent
+    if result_record.entitlement is not None:
+        return result_record
+
+    entitlement_created = False
+    has_permissions = result_record.permission is not None and result_record.permission != ''
+    skip_entitlement = roster is not None and \
+        roster.classify(result_record.action, result_record.advisor_id) == NO_OP
+
+    # Add User to Entitlement
+    if result_record.action == "ADD" and skip_entitlement:
+        print(f"Skipping {result_record.advisor_id} - already entitled")
+        result_record.entitlement = ENTITLEMENT_UNCHANGED
+        user_id = entitlement_user_id(roster.get(result_record.advisor_id)) if check_app and app_id != '' else None
+        if user_id:
+            result_record.app_action = 'install'
+            result_record.app_user_id = user_id
+
+    elif result_record.action == "ADD":
+        print(f"Adding {result_record.advisor_id}")
+        entitlement_created = yield from add_entitlement(result_record, entitlement_client, app_id, roster, check_app)
+
+
+    # Add Permissions - only the ones the advisor does not hold yet
+    if result_record.action == "ADD" and has_permissions and result_record.entitlement != ENTITLEMENT_DEFERRED:
+        yield from sync_permissions(result_record, entitlement_client, entitlement_created, revoke_permissions)
+
+    # Remove User to Entitlement
+    if result_record.action == "REMOVE" and skip_entitlement:
+        print(f"Skipping {result_record.advisor_id} - not entitled")
+        result_record.entitlement = ENTITLEMENT_UNCHANGED
+
+    elif result_record.action == "REMOVE":
+        print(f"Removing Entitlement - {result_record.advisor_id}")
+        try:
+            # Get User ID - reconcile mode already has it from the roster
+            user_id = None
+            if roster is not None:
+                user_id = entitlement_user_id(roster.get(result_record.advisor_id))
+            elif app_id != '':
+                user_id = entitlement_user_id(
+                    (yield partial(entitlement_client.find_entitlement, result_record.advisor_id)))
+
+            # Remove Entitlement
+            output = yield partial(entitlement_client.delete_entitlements, result_record.advisor_id)
+            record_removed_entitlement(result_record, output, app_id, user_id, roster)
+
+        except DeferredCallError as ex:
+            record_deferred_entitlement(result_record, ex)
+        except Exception as ex:
+            exInfo = sys.exc_info()
+            print(f" ##### ERROR WHILE REMOVING {result_record.advisor_id} #####")
+            print('Stack Trace: ' + ''.join(traceback.format_exception(exInfo[0], exInfo[1], exInfo[2])))
+            result_record.entitlement = ENTITLEMENT_FAILED
+
+    return result_record
+
+
+def add_entitlement(result_record, entitlement_client, app_id, roster=None, check_app=False):
+    """Create the entitlement, returns True if it was created - a step generator, see row_steps"""
+    try:
+        output = yield partial(entitlement_client.add_entitlements, result_record.advisor_id)
+        return record_added_entitlement(result_record, output, app_id, roster, check_app)
+
+    except DeferredCallError as ex:
+        record_deferred_entitlement(result_record, ex)
+        return False
+    except Exception as ex:
+        exInfo = sys.exc_info()
+        print(f" ##### ERROR WHILE ADDING ENTITLEMENT {result_record.advisor_id} #####")
+        print('Stack Trace: ' + ''.join(traceback.format_exception(exInfo[0], exInfo[1], exInfo[2])))
+        result_record.entitlement = ENTITLEMENT_FAILED
+        return False
+
+
+def record_deferred_entitlement(result_record, ex):
+    print(f"Deferring {result_record.advisor_id} - {ex}")
+    result_record.entitlement = ENTITLEMENT_DEFERRED
+    result_record.entitlement_detail = str(ex)
+
+
+def entitlement_user_id(output):
+    """Symphony user id of an entitlement returned by the API, None if it has none"""
+    user_id = None
+    if output is None:
+        return user_id
+    if 'advisorSymphonyId' in output:
+        user_id = output['advisorSymphonyId']
+    if 'symphonyId' in output:
+        user_id = output['symphonyId']
+    return user_id
+
+
+def record_added_entitlement(result_record, output, app_id, roster=None, check_app=False):
+    """Record the response of an entitlement POST, returns True if the entitlement was created"""
+    if 'status' in output and 'title' in output:
+        result_record.entitlement = ENTITLEMENT_REJECTED
+        result_record.entitlement_detail = f'{output["status"]} - {output["title"]}'
+        # Already entitled - when resuming, the interrupted run may have stopped before installing the
+        # Connect App, so it is checked too (users that already have it are not updated)
+        if check_app and app_id != '' and str(output['status']) == '409':
+            result_record.app_action = 'install'
+            result_record.app_user_id = result_record.advisor_id
+        return False
+
+    result_record.entitlement = ENTITLEMENT_ADDED
+    result_record.roster_entry = output
+    if roster is not None:
+        roster.mark_added(result_record.advisor_id, output)
+
+    # Install Connect App if AppId is set - applied in batches, see apply_app_changes
+    user_id = entitlement_user_id(output)
+    if app_id != '' and user_id:
+        result_record.app_action = 'install'
+        result_record.app_user_id = user_id
+    return True
+
+
+def record_removed_entitlement(result_record, output, app_id, user_id, roster=None):
+    """Record the response of an entitlement DELETE"""
+    if 'status' in output and 'title' in output:
+        result_record.entitlement = ENTITLEMENT_REJECTED
+        result_record.entitlement_detail = f'{output["status"]} - {output["title"]}'
+        return
+
+    result_record.entitlement = ENTITLEMENT_REMOVED
+    if roster is not None:
+        roster.mark_removed(result_record.advisor_id)
+
+    # Remove Connect App if AppId is set - applied in batches, see apply_app_changes
+    if app_id != '' and user_id is not None:
+        result_record.app_action = 'remove'
+        result_record.app_user_id = user_id
+
+
+def read_current_permissions(entitlement_client, advisor_id):
+    try:
+        return (yield partial(entitlement_client.get_advisor_permission_names, advisor_id))
+    except DeferredCallError:
+        raise
+    except Exception as ex:
+        print(f"Unable to read current permissions for {advisor_id} - adding all requested permissions: {ex}")
+        return set()
+
+
+def sync_permissions(result_record, entitlement_client, entitlement_created=False, revoke=False):
+    print(f"Parsing Permissions")
+    advisor_id = result_record.advisor_id
+    requested = requested_permissions(result_record, (yield entitlement_client.get_permission_catalog))
+
+    # Read current permissions once - a newly created entitlement has none
+    current = set()
+    if not entitlement_created:
+        try:
+            current = yield from read_current_permissions(entitlement_client, advisor_id)
+        except DeferredCallError as ex:
+            record_deferred_permissions(result_record, requested, ex)
+            return
+
+    # Grants and revokes do not depend on each other - send them together
+    grants, revokes = permission_changes(requested, current, revoke)
+    results = yield [grant_permission(entitlement_client, advisor_id, p) for p in grants] + \
+                    [revoke_permission(entitlement_client, advisor_id, p) for p in revokes]
+    record_permission_outcomes(result_record, requested, current, revokes, dict(zip(grants + revokes, results)))
+
+
+def requested_permissions(result_record, catalog):
+    """Permission names of the row, without duplicates. Names missing from a non-empty catalog are
+    recorded as unknown - so typos fail locally - and left out."""
+    requested = []
+    for p in result_record.permission.split("~"):
+        p = p.strip()
+        if p != '' and p not in requested:
+            requested.append(p)
+
+    if len(catalog) > 0:
+        for p in [p for p in requested if p not in catalog]:
+            result_record.add_permission_outcome(PERMISSION_UNKNOWN, p)
+        requested = [p for p in requested if p in catalog]
+    return requested
+
+
+def permission_changes(requested, current, revoke=False):
+    """Returns (permissions to grant, permissions to revoke)"""
+    grants = [p for p in requested if p not in current]
+    # Revoke permissions that are no longer listed (opt-in)
+    revokes = sorted(current - set(requested)) if revoke else []
+    return grants, revokes
+
+
+def record_deferred_permissions(result_record, requested, ex):
+    print(f"Deferring permissions of {result_record.advisor_id} - {ex}")
+    for p in requested:
+        result_record.add_permission_outcome(PERMISSION_DEFERRED, p, str(ex))
+
+
+def record_permission_outcomes(result_record, requested, current, revokes, outcomes):
+    """Record the outcome of every requested and revoked permission in a stable order"""
+    for p in requested:
+        if p in current:
+            result_record.add_permission_outcome(PERMISSION_HELD, p)
+        else:
+            result_record.add_permission_outcome(*outcomes[p])
+    for p in revokes:
+        result_record.add_permission_outcome(*outcomes[p])
+
+
+def grant_permission(entitlement_client, advisor_id, p):
+    """Add one permission, returns its (outcome, name, detail)"""
+    print(f"Adding Permission - {p}")
+    try:
+        return grant_outcome(p, (yield partial(entitlement_client.add_permission, advisor_id, p)))
+
+    except DeferredCallError as ex:
+        return PERMISSION_DEFERRED, p, str(ex)
+    except Exception as ex:
+        exInfo = sys.exc_info()
+        print(f" ##### ERROR WHILE ADDING PERMISSION {p} for {advisor_id} #####")
+        print(
+            'Stack Trace: ' + ''.join(traceback.format_exception(exInfo[0], exInfo[1], exInfo[2])))
+        return PERMISSION_ADD_FAILED, p, None
+
+
+def grant_outcome(p, output):
+    if 'permission' in output:
+        return PERMISSION_ADDED, p, None
+    elif 'status' in output and 'title' in output:
+        return PERMISSION_REJECTED, p, f'{output["status"]} - {output["title"]}'
+    else:
+        return PERMISSION_NOT_ADDED, p, None
+
+
+def revoke_permission(entitlement_client, advisor_id, p):
+    """Revoke one permission, returns its (outcome, name, detail)"""
+    print(f"Revoking Permission - {p}")
+    try:
+        return revoke_outcome(p, (yield partial(entitlement_client.delete_permission, advisor_id, p)))
+
+    except DeferredCallError as ex:
+        return PERMISSION_DEFERRED, p, str(ex)
+    except Exception as ex:
+        exInfo = sys.exc_info()
+        print(f" ##### ERROR WHILE REVOKING PERMISSION {p} for {advisor_id} #####")
+        print(
+            'Stack Trace: ' + ''.join(traceback.format_exception(exInfo[0], exInfo[1], exInfo[2])))
+        return PERMISSION_REVOKE_FAILED, p, None
+
+
+def revoke_outcome(p, output):
+    if isinstance(output, dict) and 'status' in output and 'title' in output:
+        return PERMISSION_REJECTED, p, f'{output["status"]} - {output["title"]}'
+    else:
+        return PERMISSION_REVOKED, p, None
+
+
+def apply_app_changes(results, pod_user_client, app_id, batch_size, keeps_app=None):
+    """Install / remove the extension app for completed rows in batches, keeping the row order.
+
+    The app is per user, not per network: a row reversing the app change of a user already in the batch
+    starts a new batch, so the changes to one user are applied in row order.
+    """
+    batch = []
+    for result_record in results:
+        if reverses_app_change(batch, result_record):
+            yield from drive_steps(apply_app_batch(batch, pod_user_client, app_id, keeps_app))
+            batch = []
+        batch.append(result_record)
+        if len(batch) >= batch_size:
+            yield from drive_steps(apply_app_batch(batch, pod_user_client, app_id, keeps_app))
+            batch = []
+
+    yield from drive_steps(apply_app_batch(batch, pod_user_client, app_id, keeps_app))
+
+
+async def apply_app_changes_async(results, pod_user_client, app_id, batch_size, keeps_app=None):
+    """apply_app_changes for the async transport - results is an async iterator"""
+    batch = []
+    async for result_record in results:
+        if reverses_app_change(batch, result_record):
+            for applied in await drive_steps_async(apply_app_batch(batch, pod_user_client, app_id, keeps_app)):
+                yield applied
+            batch = []
+        batch.append(result_record)
+        if len(batch) >= batch_size:
+            for applied in await drive_steps_async(apply_app_batch(batch, pod_user_client, app_id, keeps_app)):
+                yield applied
+            batch = []
+
+    for applied in await drive_steps_async(apply_app_batch(batch, pod_user_client, app_id, keeps_app)):
+        yield applied
+
+
+def reverses_app_change(batch, result_record):
+    """True if the row changes the extension app of a user that the batch changes the other way - a batch
+    sends its installs before its removes"""
+    if result_record.app_action is None:
+        return False
+    user_id = RosterIndex.normalize_id(result_record.app_user_id)
+    return any(r.app_action not in (None, result_record.app_action) and
+               RosterIndex.normalize_id(r.app_user_id) == user_id for r in batch)
+
+
+def apply_app_batch(batch, pod_user_client, app_id, keeps_app=None):
+    """Send the extension app changes of a batch of rows - a step generator, see row_steps.
+
+    keeps_app(row) is a step generator telling whether the app of a REMOVE row's user must be kept.
+    """
+    removes = [r for r in batch if r.app_action == 'remove'] if keeps_app is not None else []
+    if len(removes) > 0:
+        for result_record, keep in zip(removes, (yield [keeps_app(r) for r in removes])):
+            if keep:
+                result_record.app_action = None
+                result_record.app = APP_KEPT
+
+    install_ids, remove_ids = app_changes(batch)
+
+    outcomes = dict()
+    if len(install_ids) > 0:
+        print(f"Installing {app_id} extension app for {len(install_ids)} user(s)")
+        outcomes['install'] = yield partial(pod_user_client.install_connect_app_bulk, install_ids)
+    if len(remove_ids) > 0:
+        print(f"Removing {app_id} extension app for {len(remove_ids)} user(s)")
+        outcomes['remove'] = yield partial(pod_user_client.remove_connect_app_bulk, remove_ids)
+
+    return record_app_outcomes(batch, outcomes, app_id)
+
+
+def stays_entitled(clients, rosters, run_actions, result_record):
+    """True if the user of a REMOVE row stays entitled to another network of the run - a step generator.
+
+    The final action of the run's plans decides first, then the roster of the network when it is
+    loaded, else the entitlement is looked up. A failed lookup keeps the app.
+    """
+    actions = run_actions.get(RosterIndex.normalize_id(result_record.advisor_id), dict())
+    for network, client in clients.items():
+        if network == result_record.network or actions.get(network) == "REMOVE":
+            continue
+        if actions.get(network) == "ADD":
+            return True
+
+        if network in rosters:
+            entitlement = rosters[network].get(result_record.advisor_id)
+        else:
+            try:
+                entitlement = yield partial(client.find_entitlement, result_record.advisor_id)
+            except Exception as ex:
+                print(f"Unable to look up {result_record.advisor_id} on {network} - keeping the extension app: {ex}")
+                return True
+        if entitlement_user_id(entitlement) is not None:
+            return True
+    return False
+
+
+def app_changes(batch):
+    """Returns (user ids to install the app for, user ids to remove it from)"""
+    install_ids = [r.app_user_id for r in batch if r.app_action == 'install']
+    remove_ids = [r.app_user_id for r in batch if r.app_action == 'remove']
+    return install_ids, remove_ids
+
+
+def record_app_outcomes(batch, outcomes, app_id):
+    for result_record in batch:
+        if result_record.app_action is None:
+            continue
+
+        outcome = outcomes[result_record.app_action][result_record.app_user_id]
+        if isinstance(outcome, Exception):
+            print(f" ##### ERROR WHILE UPDATING {app_id} EXTENSION APP FOR {result_record.advisor_id} #####")
+            print('Stack Trace: ' + ''.join(traceback.format_exception(type(outcome), outcome, outcome.__traceback__)))
+            result_record.app = APP_FAILED
+        else:
+            result_record.app = APP_UPDATED if outcome else APP_UNCHANGED
+
+    return batch
+
+
+def track_rosters(results, rosters):
+    """Apply the entitlements created / removed by completed rows to the rosters kept by watch mode"""
+    for result_record in results:
+        roster = rosters.get(result_record.network)
+        if roster is not None and result_record.entitlement == ENTITLEMENT_ADDED:
+            roster.mark_added(result_record.advisor_id, result_record.roster_entry)
+        elif roster is not None and result_record.entitlement == ENTITLEMENT_REMOVED:
+            roster.mark_removed(result_record.advisor_id)
+        # Only needed until the roster is updated
+        result_record.roster_entry = None
+        yield result_record
+
+
+def render_results(rows, app_id):
+    """Pair each completed row with its status text - rendered here, just before it is written"""
+    for row in rows:
+        yield row, render_status(row, app_id)
+
+
+def journal_results(results, journal, deferred_rows=None):
+    """Journal the completed rows - deferred rows are left out (and added to deferred_rows) so a resumed
+    run processes them again"""
+    for row, status in results:
+        if is_deferred(row.plan if row.plan is not None else row):
+            if deferred_rows is not None:
+                deferred_rows.append(row.row_number)
+        elif not row.resumed:
+            journal.record(row.row_number, row.row_hash, status)
+        run_metrics.record_row(status_summary_key(row))
+        yield row, status
+
 
+def print_curent_user_list(process_result, user_file=USER_FILE):
+    # process_result may be a generator - rows are written as they are received
+    records = iter(process_result)
+    first_record = next(records, None)
 
-            # Add User to Entitlement
-            if result_record['ent_action'] == "ADD":
-                print(f"Adding {result_record['advisorSymphonyId']}")
-                try:
-                    output = entitlement_client.add_entitlements(result_record['advisorSymphonyId'])
-                    if 'status' in output and 'title' in output:
-                        result_record['result'] = f'{output["status"]} - {output["title"]} '
-                    else:
-                        result_record['result'] = 'User added to Entitlement. '
-
-                        if 'advisorSymphonyId' in output:
-                            user_id = output['advisorSymphonyId']
-                        if 'symphonyId' in output:
-                            user_id = output['symphonyId']
-
-                        # Install Connect App if AppId is set
-                        if configure.data["appId"] != '' and user_id != '':
-                            print(f"Installing {configure.data['appId']} extension app")
-                            if pod_user_client.install_connect_app_by_userid(user_id):
-                                result_record['result'] = f'User added to Entitlement. {configure.data["appId"]} extension app installed Successfully!'
-
-                except Exception as ex:
-                    exInfo = sys.exc_info()
-                    print(f" ##### ERROR WHILE ADDING ENTITLEMENT {result_record['advisorSymphonyId']} #####")
-                    print('Stack Trace: ' + ''.join(traceback.format_exception(exInfo[0], exInfo[1], exInfo[2])))
-                    result_record['result'] = 'ERROR ADDING Entitlement - Check logs for details'
-
-
-                # Add Permissions
-                if result_record['permission'] is not None and result_record['permission'] != '':
-                    print(f"Parsing Permissions")
-                    permission_list = result_record['permission'].split("~")
-
-                    if permission_list is not None and len(permission_list) > 0:
-                        for p in permission_list:
-                            print(f"Adding Permission - {p}")
-                            try:
-                                output = entitlement_client.add_permission(result_record['advisorSymphonyId'], p)
-                                if 'permission' in output:
-                                    result_record['result'] += f'Permission {p} added successfully '
-                                elif 'status' in output and 'title' in output:
-                                    result_record['result'] += f'{output["status"]} - {output["title"]} '
-                                else:
-                                    result_record['result'] += f'ERROR - Fail to add permission {p} '
-
-                            except Exception as ex:
-                                exInfo = sys.exc_info()
-                                print(f" ##### ERROR WHILE ADDING PERMISSION {p} for {result_record['advisorSymphonyId']} #####")
-                                print(
-                                    'Stack Trace: ' + ''.join(traceback.format_exception(exInfo[0], exInfo[1], exInfo[2])))
-                                result_record['result'] += f'ERROR ADDING PERMISSION {p} - Check logs for details '
-
-            # Remove User to Entitlement
-            if result_record['ent_action'] == "REMOVE":
-                print(f"Removing Entitlement - {result_record['advisorSymphonyId']}")
-                try:
-                    # Get User ID
-                    if configure.data["appId"] != '':
-                        output = entitlement_client.find_entitlement(result_record['advisorSymphonyId'])
-                        if 'advisorSymphonyId' in output:
-                            user_id = output['advisorSymphonyId']
-                        if 'symphonyId' in output:
-                            user_id = output['symphonyId']
-
-                    # Remove Entitlement
-                    output = entitlement_client.delete_entitlements(result_record['advisorSymphonyId'])
-                    if 'status' in output and 'title' in output:
-                        result_record['result'] = f'{output["status"]} - {output["title"]}'
-                    else:
-                        result_record['result'] = 'Entitlement Removed successfully'
-
-                        # Remove Connect App if AppId is set
-                        if configure.data["appId"] != '' and user_id is not None:
-                            print(f"Removing {configure.data['appId']} extension app")
-                            if pod_user_client.remove_connect_app_by_userid(user_id):
-                                result_record['result'] = f'User removed from Entitlement. {configure.data["appId"]} extension app removed Successfully!'
-
-                except Exception as ex:
-                    exInfo = sys.exc_info()
-                    print(f" ##### ERROR WHILE REMOVING {result_record['advisorSymphonyId']} #####")
-                    print('Stack Trace: ' + ''.join(traceback.format_exception(exInfo[0], exInfo[1], exInfo[2])))
-                    result_record['result'] = 'ERROR REMOVING Entitlement - Check logs for details'
-
-            # Append Result
-            process_result.append(result_record)
-
-    # Print final result
-    print(f'Generating Result Files...')
-    print_result(process_result)
-
-    # Print Current User List
-    print(f'Generating Current User List...')
-    user_list = entitlement_client.list_entitlements()
-    print_curent_user_list(user_list)
-
-
-def print_curent_user_list(process_result):
-
-    if len(process_result) > 0:
-        with open(USER_FILE, 'w', newline='', encoding='utf-8-sig') as csvfile:
+    if first_record is not None:
+        with open(user_file, 'w', newline='', encoding='utf-8-sig') as csvfile:
             fieldnames = ['UserID',
                           'First Name',
                           'Last Name',
@@ -172,32 +1008,37 @@ def print_curent_user_list(process_result):
 
             writer.writeheader()
 
-            for record in process_result:
+            for record in itertools.chain([first_record], records):
                 writer.writerow(
                     {'UserID': record['symphonyId'],
                      'First Name': record['firstName'] if 'firstName' in record else '',
                      'Last Name': record['lastName'] if 'lastName' in record else '',
-                     'Display Name': record['displayName'],
-                     'External Network': record['externalNetwork']})
+                     'Display Name': record['displayName'] if 'displayName' in record else '',
+                     'External Network': record['externalNetwork'] if 'externalNetwork' in record else ''})
 
     return
 
 
-def print_result(process_result):
-    with open(OUTPUT_FILE, 'w', newline='', encoding='utf-8-sig') as csvfile:
+def print_result(process_result, include_network=False, output_file=OUTPUT_FILE):
+    with open(output_file, 'w', newline='', encoding='utf-8-sig') as csvfile:
         fieldnames = ['advisorSymphonyId',
                       'Action',
                       'Permissions',
                       'Status']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        if include_network:
+            fieldnames.insert(3, 'Network')
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
 
         writer.writeheader()
-        for row in process_result:
+        # process_result yields (row, status) - each row is flushed as soon as it is available
+        for row, status in process_result:
             writer.writerow(
-                {'advisorSymphonyId': row['advisorSymphonyId'],
-                 'Action': row['ent_action'],
-                 'Permissions': row['permission'],
-                 'Status': row['result']})
+                {'advisorSymphonyId': row.advisor_id,
+                 'Action': row.action,
+                 'Permissions': row.permission,
+                 'Network': row.network,
+                 'Status': status})
+            csvfile.flush()
 
     return
 
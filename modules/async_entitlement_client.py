@@ -0,0 +1,178 @@
+import aiohttp
+import asyncio
+import ssl
+import time
+from modules.entitlement_client import EntitlementClient
+from modules.throttling import AsyncAdaptiveConcurrencyLimiter, DeferredCallError
+
+
+class AsyncEntitlementClient(EntitlementClient):
+    """asyncio variant of EntitlementClient, sending its calls with aiohttp.
+
+    The request methods (add_entitlements, add_permission, delete_entitlements, find_entitlement...)
+    are inherited unchanged: they return the coroutine of execute_rest_call and are awaited by the
+    caller. Pass the SymBotRSAAuth of the synchronous client to share its JWT cache, and its
+    rate_limiter to share the requestsPerSecond budget. Calls in flight are bounded by an adaptive
+    semaphore of `concurrency` slots, so thousands of rows can wait on the API without a thread each.
+
+    The client belongs to the event loop it is first used on.
+    """
+
+    def __init__(self, auth, config, connect_app):
+        super().__init__(auth, config, connect_app)
+        self.concurrency_limiter = AsyncAdaptiveConcurrencyLimiter(int(config.data.get('concurrency', 1)))
+        self._catalog_task = None
+        # Counters of the aiohttp trace hooks, see connection_stats
+        self._connections_opened = 0
+        self._requests_sent = 0
+
+
+    async def list_entitlements(self):
+        return [entitlement async for entitlement in self.iter_entitlements()]
+
+
+    async def iter_entitlements(self):
+        """Yield the entitlement roster one advisor at a time, requesting the next page in the background"""
+        url = f'/admin/api/v1/customer/entitlements/externalNetwork/{self.entitlementType}/advisors'
+
+        output = await self.execute_rest_call("GET", url)
+        next_page = None
+        try:
+            while 'entitlements' in output and len(output['entitlements']) > 0:
+                next_page = None
+                if 'pagination' in output:
+                    if 'next' in output['pagination'] and output['pagination']['next'] is not None:
+                        next_url = url + output['pagination']['next']
+                        next_page = asyncio.ensure_future(self.execute_rest_call("GET", next_url))
+
+                for entitlement in output['entitlements']:
+                    yield entitlement
+
+                output = await next_page if next_page is not None else dict()
+        finally:
+            if next_page is not None and not next_page.done():
+                next_page.cancel()
+
+
+    async def get_permission_catalog(self):
+        """Return the set of valid permission names, fetched once - concurrent callers share the request"""
+        if self.parent is not None:
+            return await self.parent.get_permission_catalog()
+
+        if self.permission_catalog is None:
+            if self._catalog_task is None:
+                self._catalog_task = asyncio.ensure_future(self._load_permission_catalog())
+            task = self._catalog_task
+            await asyncio.shield(task)
+            if self.permission_catalog is None:
+                # Deferred - the next caller loads it again
+                if self._catalog_task is task:
+                    self._catalog_task = None
+                return set()
+        return self.permission_catalog
+
+
+    async def _load_permission_catalog(self):
+        try:
+            self.permission_catalog = self.permission_names(await self.list_all_permissions())
+        except DeferredCallError as ex:
+            print(f'Permission catalog not loaded - permission names will not be validated: {ex}')
+        except Exception as ex:
+            print(f'Unable to load permission catalog - permission names will not be validated: {ex}')
+            self.permission_catalog = set()
+
+
+    async def get_advisor_permission_names(self, advisorSymphonyId):
+        return self.permission_names(await self.list_permissions_by_advisor(advisorSymphonyId))
+
+
+    def get_session(self):
+        """Return the aiohttp session, creating it on first use - must be called from the event loop.
+
+        The connector keeps up to `concurrency` connections alive, the Authorization header is set per
+        request, see execute_rest_call.
+        """
+        if self.parent is not None:
+            return self.parent.get_session()
+
+        if self.session is not None:
+            return self.session
+
+        ssl_context = ssl.create_default_context()
+        if self.config.data["truststorePath"]:
+            print("Setting truststorePath to {}".format(
+                self.config.data["truststorePath"])
+            )
+            ssl_context = ssl.create_default_context(cafile=self.config.data["truststorePath"])
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_created)
+        trace_config.on_request_end.append(self._on_request_sent)
+
+        pool_size = max(1, int(self.config.data.get('concurrency', 1)))
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size, ssl=ssl_context),
+            headers={'Content-Type': "application/json"},
+            timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]),
+            trace_configs=[trace_config])
+        return self.session
+
+
+    async def _on_connection_created(self, session, context, params):
+        self._connections_opened += 1
+
+
+    async def _on_request_sent(self, session, context, params):
+        self._requests_sent += 1
+
+
+    def connection_stats(self):
+        """Return (connections opened, requests sent) by the session's connector"""
+        if self.parent is not None:
+            return self.parent.connection_stats()
+
+        return self._connections_opened, self._requests_sent
+
+
+    async def close(self):
+        if self.parent is None and self.session is not None:
+            await self.session.close()
+
+
+    async def execute_rest_call(self, method, path, retry_auth=True, **kwargs):
+        """execute_rest_call sent with aiohttp - retries, circuit breaker and results are handled by the
+        EntitlementClient helpers"""
+        url = self.config.data['apiURL'] + path
+        session = self.get_session()
+        proxies = self.config.data['proxyRequestObject']
+        proxy = proxies.get('https') or proxies.get('http')
+        breaker = self.call_breaker(method, path)
+
+        attempt = 0
+        while True:
+            # Always send the current token - the cache rotates it shortly before it expires
+            jwt = self.auth.get_jwt(self.entitlementType)
+            headers = {'Authorization': "Bearer " + jwt}
+            await self.rate_limiter.acquire_async()
+            connect_timeout, read_timeout = self.call_timeout()
+            timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+            start = time.perf_counter()
+            try:
+                async with self.concurrency_limiter:
+                    async with session.request(method, url, headers=headers, proxy=proxy, timeout=timeout,
+                                               **kwargs) as response:
+                        status_code = response.status
+                        text = await response.text()
+                        retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+                self.call_failed(method, path, err, start, breaker)
+
+            delay = self.retry_delay_after(method, path, status_code, retry_after, attempt, start)
+            if delay is None:
+                break
+            attempt += 1
+            await asyncio.sleep(delay)
+
+        if self.complete_call(breaker, status_code, jwt, retry_auth):
+            return await self.execute_rest_call(method, path, retry_auth=False, **kwargs)
+        return self.call_results(url, status_code, text)
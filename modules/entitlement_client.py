@@ -1,6 +1,28 @@
+import copy
 import requests
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from json.decoder import JSONDecodeError
+from requests.adapters import HTTPAdapter
+from modules.metrics import run_metrics, endpoint_template
+from modules.throttling import (TokenBucketRateLimiter, AdaptiveConcurrencyLimiter, CircuitBreakers, RunDeadline,
+                                CircuitOpenError, DeadlineExceededError, DeferredCallError, UnavailableError,
+                                retry_delay)
+
+# Default timeouts (seconds) - can be overridden with connectTimeout / readTimeout in config.json
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+# Responses that mean the server is throttling us or temporarily unavailable
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+# Default retry settings - can be overridden with maxRetries / retryBackoffSeconds in config.json
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_BACKOFF = 0.5
+# Default circuit breaker settings - can be overridden with circuitBreakerFailures / circuitBreakerResetSeconds
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_RESET_SECONDS = 30
 
 
 class EntitlementClient():
@@ -8,29 +30,69 @@ class EntitlementClient():
     def __init__(self, auth, config, connect_app):
         self.auth = auth
         self.config = config
-        self.jwt = None
         self.entitlementType = connect_app
+        # Client this one was derived from with for_network - owns the shared session and catalog
+        self.parent = None
+        self.session = None
+        self._session_lock = threading.Lock()
+        self.permission_catalog = None
+        self._catalog_lock = threading.Lock()
+        self.timeout = (float(config.data.get('connectTimeout', DEFAULT_CONNECT_TIMEOUT)),
+                        float(config.data.get('readTimeout', DEFAULT_READ_TIMEOUT)))
+
+        # Stay under requestsPerSecond (0 = unlimited) and back off when the API throttles us
+        self.rate_limiter = TokenBucketRateLimiter(float(config.data.get('requestsPerSecond', 0)))
+        self.concurrency_limiter = AdaptiveConcurrencyLimiter(int(config.data.get('concurrency', 1)))
+        self.max_retries = int(config.data.get('maxRetries', DEFAULT_MAX_RETRIES))
+        self.retry_backoff = float(config.data.get('retryBackoffSeconds', DEFAULT_RETRY_BACKOFF))
+
+        # Calls fail fast once the run deadline has passed or their endpoint keeps failing
+        self.deadline = RunDeadline(config.data.get('runDeadlineSeconds', 0))
+        self.circuit_breakers = CircuitBreakers(
+            int(config.data.get('circuitBreakerFailures', DEFAULT_BREAKER_FAILURES)),
+            float(config.data.get('circuitBreakerResetSeconds', DEFAULT_BREAKER_RESET_SECONDS)))
+
+
+    def for_network(self, network):
+        """Return a client for another external network (WHATSAPP, WECHAT, SMS...).
+
+        The new client shares this client's auth and JWT cache, HTTP session and connection pool,
+        rate / concurrency limiters, run deadline, circuit breakers and permission catalog.
+        """
+        if network == self.entitlementType:
+            return self
+
+        client = copy.copy(self)
+        client.entitlementType = network
+        client.parent = self.parent or self
+        return client
 
 
     def list_entitlements(self):
+        return list(self.iter_entitlements())
+
+
+    def iter_entitlements(self):
+        """Yield the entitlement roster one advisor at a time.
+
+        The next page is requested in the background while the current page is being consumed,
+        so page latency overlaps with the caller's work and only two pages are held in memory.
+        """
         url = f'/admin/api/v1/customer/entitlements/externalNetwork/{self.entitlementType}/advisors'
 
-        user_list = []
-        output = self.execute_rest_call("GET", url)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            output = self.execute_rest_call("GET", url)
 
-        while 'entitlements' in output and len(output['entitlements']) > 0:
-            user_list = user_list + output['entitlements']
+            while 'entitlements' in output and len(output['entitlements']) > 0:
+                next_page = None
+                if 'pagination' in output:
+                    if 'next' in output['pagination'] and output['pagination']['next'] is not None:
+                        next_url = url + output['pagination']['next']
+                        next_page = executor.submit(self.execute_rest_call, "GET", next_url)
 
-            if 'pagination' in output:
-                if 'next' in output['pagination'] and output['pagination']['next'] is not None:
-                    next_url = url + output['pagination']['next']
-                    output = self.execute_rest_call("GET", next_url)
-                else:
-                    output = dict()
-            else:
-                output = dict()
+                yield from output['entitlements']
 
-        return user_list
+                output = next_page.result() if next_page is not None else dict()
 
 
     def list_all_permissions(self):
@@ -78,63 +140,256 @@ class EntitlementClient():
         return self.execute_rest_call("POST", url, json=body)
 
 
+    def delete_permission(self, advisorSymphonyId, permissionName):
+        url = f'/admin/api/v2/customer/advisors/{advisorSymphonyId}/externalNetwork/{self.entitlementType}/permissions/{permissionName}'
+
+        return self.execute_rest_call("DELETE", url)
+
+
     def list_advisor_permission(self, advisorSymphonyId):
         url = f'/admin/api/v2/customer/advisors/{advisorSymphonyId}/externalNetwork/{self.entitlementType}/permissions'
 
         return self.execute_rest_call("GET", url)
 
 
-    def get_session(self):
-        session = requests.Session()
+    def get_permission_catalog(self):
+        """Return the set of valid permission names, fetched once per client.
 
-        if self.jwt is not None:
-            jwt = self.jwt
-        else:
-            jwt = self.auth.create_jwt(self.entitlementType)
+        An empty set means the catalog could not be loaded and names should not be validated.
+        """
+        if self.parent is not None:
+            return self.parent.get_permission_catalog()
+
+        with self._catalog_lock:
+            if self.permission_catalog is None:
+                try:
+                    self.permission_catalog = self.permission_names(self.list_all_permissions())
+                except DeferredCallError as ex:
+                    # Not cached - the catalog is loaded again once the API is available
+                    print(f'Permission catalog not loaded - permission names will not be validated: {ex}')
+                    return set()
+                except Exception as ex:
+                    print(f'Unable to load permission catalog - permission names will not be validated: {ex}')
+                    self.permission_catalog = set()
 
-        session.headers.update({
-            'Content-Type': "application/json",
-            'Authorization': "Bearer " + jwt}
-        )
+            return self.permission_catalog
 
-        session.proxies.update(self.config.data['proxyRequestObject'])
-        if self.config.data["truststorePath"]:
-            print("Setting truststorePath to {}".format(
-                self.config.data["truststorePath"])
+
+    def get_advisor_permission_names(self, advisorSymphonyId):
+        return self.permission_names(self.list_permissions_by_advisor(advisorSymphonyId))
+
+
+    @staticmethod
+    def permission_names(output):
+        """Extract permission names from a permissions response, ignoring error payloads"""
+        if isinstance(output, dict):
+            output = output.get('permissions', [])
+
+        names = set()
+        for permission in output or []:
+            if isinstance(permission, str):
+                names.add(permission)
+            elif isinstance(permission, dict):
+                name = permission.get('permissionName') or permission.get('name') or permission.get('permission')
+                if name:
+                    names.add(name)
+
+        return names
+
+
+    def get_session(self):
+        """Return the long-lived session, creating it on first use.
+
+        The connection pool is sized to the configured concurrency so every worker can keep its
+        connection alive. The Authorization header is set per request, see execute_rest_call.
+        """
+        if self.parent is not None:
+            return self.parent.get_session()
+
+        with self._session_lock:
+            if self.session is not None:
+                return self.session
+
+            session = requests.Session()
+            pool_size = max(1, int(self.config.data.get('concurrency', 1)))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+
+            session.headers.update({
+                'Content-Type': "application/json"}
             )
-            session.verify = self.config.data["truststorePath"]
 
-        return session
+            session.proxies.update(self.config.data['proxyRequestObject'])
+            if self.config.data["truststorePath"]:
+                print("Setting truststorePath to {}".format(
+                    self.config.data["truststorePath"])
+                )
+                session.verify = self.config.data["truststorePath"]
 
+            self.session = session
+            return self.session
 
-    def execute_rest_call(self, method, path, **kwargs):
-        results = None
+
+    def circuit_breaker(self, path):
+        """Circuit breaker of the endpoint family of path (see metrics.endpoint_template)"""
+        return self.circuit_breakers.get(endpoint_template(path))
+
+
+    def call_timeout(self):
+        """(connect, read) timeout of the next attempt, capped by the time left before the run deadline.
+
+        Raises DeadlineExceededError once the deadline has passed.
+        """
+        remaining = self.deadline.remaining()
+        if remaining is None:
+            return self.timeout
+        if remaining <= 0:
+            raise DeadlineExceededError('Run deadline reached')
+        return min(self.timeout[0], remaining), min(self.timeout[1], remaining)
+
+
+    def check_deadline_timeout(self, err):
+        """Raise DeadlineExceededError if the call failed after the run deadline, which cut its timeout short"""
+        remaining = self.deadline.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceededError('Run deadline reached while waiting for a response') from err
+
+
+    def check_retry_delay(self, delay):
+        remaining = self.deadline.remaining()
+        if remaining is not None and delay >= remaining:
+            raise DeadlineExceededError('Run deadline reached while waiting to retry')
+
+
+    def connection_stats(self):
+        """Return (connections opened, requests sent) by the session's connection pools"""
+        if self.parent is not None:
+            return self.parent.connection_stats()
+
+        opened = 0
+        sent = 0
+        if self.session is not None:
+            # The same adapter is mounted for http and https
+            for adapter in {id(a): a for a in self.session.adapters.values()}.values():
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    opened += pools[key].num_connections
+                    sent += pools[key].num_requests
+        return opened, sent
+
+
+    def execute_rest_call(self, method, path, retry_auth=True, **kwargs):
         url = self.config.data['apiURL'] + path
         session = self.get_session()
-        try:
-            response = session.request(method, url, **kwargs)
-        except requests.exceptions.ConnectionError as err:
-            print(err)
-            print(type(err))
-            raise
-
-        if response.status_code == 204:
-            results = []
-        # JWT Expired - Generate new one
-        elif response.status_code == 401:
+        breaker = self.call_breaker(method, path)
+
+        attempt = 0
+        while True:
+            # Always send the current token - the cache rotates it shortly before it expires
+            jwt = self.auth.get_jwt(self.entitlementType)
+            headers = {'Authorization': "Bearer " + jwt}
+            self.rate_limiter.acquire()
+            timeout = self.call_timeout()
+            start = time.perf_counter()
+            try:
+                with self.concurrency_limiter:
+                    response = session.request(method, url, headers=headers, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                self.call_failed(method, path, err, start, breaker)
+
+            delay = self.retry_delay_after(method, path, response.status_code, response.headers.get('Retry-After'),
+                                           attempt, start)
+            if delay is None:
+                break
+            attempt += 1
+            time.sleep(delay)
+
+        if self.complete_call(breaker, response.status_code, jwt, retry_auth):
+            return self.execute_rest_call(method, path, retry_auth=False, **kwargs)
+        return self.call_results(url, response.status_code, response.text)
+
+
+    # Steps of execute_rest_call shared with AsyncEntitlementClient - only sending the request differs
+
+    def call_breaker(self, method, path):
+        """Circuit breaker of a call, raises CircuitOpenError if it does not let the call through"""
+        breaker = self.circuit_breaker(path)
+        if not breaker.allow():
+            raise CircuitOpenError(f'Circuit open for {method} {breaker.name}')
+        return breaker
+
+
+    def call_failed(self, method, path, err, start, breaker):
+        """Record a call that got no response - connection error or timeout - and raise UnavailableError,
+        so the row is deferred to a resumed run instead of failing"""
+        run_metrics.record_call('ces', method, path, type(err).__name__, time.perf_counter() - start)
+        self.check_deadline_timeout(err)
+        breaker.on_failure()
+        print(err)
+        print(type(err))
+        raise UnavailableError(f'{type(err).__name__} from {method} {endpoint_template(path)}') from err
+
+
+    def retry_delay_after(self, method, path, status_code, retry_after, attempt, start):
+        """Record a response, returns the delay before sending the call again or None if the response is final"""
+        run_metrics.record_call('ces', method, path, status_code, time.perf_counter() - start)
+
+        if status_code not in RETRY_STATUS_CODES:
+            self.concurrency_limiter.on_success()
+            return None
+
+        # Throttled / unavailable - back off and retry
+        self.concurrency_limiter.on_throttled()
+        if attempt >= self.max_retries:
+            return None
+        delay = retry_delay(attempt, self.retry_backoff, retry_after)
+        self.check_retry_delay(delay)
+        run_metrics.record_retry('ces', method, path)
+        print(f'Status Code {status_code} from {method} {path} - '
+              f'retrying in {delay:.1f}s (attempt {attempt + 1} of {self.max_retries})')
+        return delay
+
+
+    def complete_call(self, breaker, status_code, jwt, retry_auth):
+        """Report the final status of a call to its circuit breaker.
+
+        Returns True if the JWT expired and the call must be sent again (once) with a new one.
+        """
+        # Server errors and throttling that outlasted the retries count towards opening the endpoint's circuit,
+        # any other answer closes it
+        if status_code >= 500 or status_code in RETRY_STATUS_CODES:
+            breaker.on_failure()
+        else:
+            breaker.on_success()
+
+        # JWT Expired - Generate new one and retry once
+        if status_code == 401 and retry_auth:
             print("JWT Expired - Reauthenticating...")
-            self.jwt = None
-            return self.execute_rest_call(method, path, **kwargs)
-        elif response.status_code in (200, 409, 201, 404, 400):
+            self.auth.invalidate_jwt(jwt)
+            return True
+        return False
+
+
+    def call_results(self, url, status_code, text):
+        """Results of a final response, raises on an unexpected status - UnavailableError for throttling or
+        server errors that outlasted the retries"""
+        results = None
+        if status_code == 204:
+            results = []
+        elif status_code in (200, 409, 201, 404, 400):
             try:
-                results = json.loads(response.text)
+                results = json.loads(text)
             except JSONDecodeError:
-                results = response.text
+                results = text
+        elif status_code >= 500 or status_code in RETRY_STATUS_CODES:
+            print(f'Status Code {status_code} from {url} - API unavailable')
+            raise UnavailableError(f'Status Code {status_code}')
         else:
             # Try to get the json to be used to handle the error message
             print('Failed while invoking ' + url)
-            print('Status Code: ' + str(response.status_code))
-            print('Response: ' + response.text)
-            raise Exception(response.text)
+            print('Status Code: ' + str(status_code))
+            print('Response: ' + text)
+            raise Exception(text)
 
         return results
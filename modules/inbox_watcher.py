@@ -0,0 +1,63 @@
+import os
+import time
+
+# Default time between two scans of the inbox
+POLL_SECONDS = 2.0
+
+
+class InboxWatcher():
+    """Poll a directory for new CSV files and yield their paths, oldest first.
+
+    A file is only picked up once it has not been modified for settle_seconds, so a file that is
+    still being copied into the inbox is never read half-written. Processed files are expected to be
+    moved out of the directory; a file that is still there unchanged is not yielded twice.
+    """
+
+    def __init__(self, directory, poll_seconds=POLL_SECONDS, settle_seconds=1.0):
+        self.directory = directory
+        self.poll_seconds = poll_seconds
+        self.settle_seconds = settle_seconds
+        # Modification time and size of every file already yielded
+        self._seen = dict()
+
+
+    def __iter__(self):
+        while True:
+            yield from self.ready_files()
+            time.sleep(self.poll_seconds)
+
+
+    def ready_files(self):
+        now = time.time()
+        ready = []
+        # Rebuilt from this scan - a file that left the inbox is forgotten, so moving it back (even with
+        # its old modification time, as mv does) processes it again
+        seen = dict()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith('.csv'):
+                    continue
+
+                stat = entry.stat()
+                signature = (stat.st_mtime, stat.st_size)
+                if self._seen.get(entry.path) == signature:
+                    seen[entry.path] = signature
+                    continue
+                if now - stat.st_mtime < self.settle_seconds:
+                    continue
+                ready.append((stat.st_mtime, entry.name, entry.path, signature))
+
+        paths = []
+        for mtime, name, path, signature in sorted(ready):
+            seen[path] = signature
+            paths.append(path)
+        self._seen = seen
+        return paths
+
+
+def read_paths(stream):
+    """Yield the file paths listed on stream, one per line, until it is closed"""
+    for line in stream:
+        path = line.strip()
+        if path != '':
+            yield path
@@ -0,0 +1,238 @@
+import json
+import os
+import re
+import threading
+import time
+from array import array
+
+# Path segments replaced by a placeholder so calls are grouped per endpoint template
+ID_SEGMENT = re.compile(r'^\d+$')
+PROMETHEUS_PREFIX = 'connect_entitlements'
+
+
+def endpoint_template(path):
+    """Turn a request path into its endpoint template, e.g. /advisors/123/permissions -> /advisors/{id}/permissions"""
+    segments = path.split('?', 1)[0].split('/')
+    for index, segment in enumerate(segments):
+        if ID_SEGMENT.match(segment):
+            segments[index] = '{id}'
+        elif index > 0 and segments[index - 1] == 'permissions' and segment != '':
+            segments[index] = '{name}'
+    return '/'.join(segments)
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class EndpointStats():
+    __slots__ = ('count', 'statuses', 'retries', 'latencies')
+
+    def __init__(self):
+        self.count = 0
+        self.statuses = dict()
+        self.retries = 0
+        self.latencies = array('d')
+
+
+class RunMetrics():
+    """Thread-safe call counters, status histograms and latencies for one run.
+
+    Calls are grouped by client (ces / pod), HTTP method and endpoint template.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._started_counter = time.perf_counter()
+        self.phases = dict()
+        self.endpoints = dict()
+        self.jwt_mints = 0
+        self.jwt_sign_seconds = 0.0
+        self.rows = 0
+        self.row_statuses = dict()
+        # Connection pool counters of this process, and the ones added from other processes by merge
+        self.connections = dict()
+        self._merged_connections = dict()
+
+
+    def _endpoint(self, client, method, path):
+        key = (client, method, endpoint_template(path))
+        stats = self.endpoints.get(key)
+        if stats is None:
+            stats = self.endpoints[key] = EndpointStats()
+        return stats
+
+
+    def record_call(self, client, method, path, status, latency):
+        """status is the HTTP status code, or the exception name when no response was received"""
+        with self._lock:
+            stats = self._endpoint(client, method, path)
+            stats.count += 1
+            stats.statuses[str(status)] = stats.statuses.get(str(status), 0) + 1
+            stats.latencies.append(latency)
+
+
+    def record_retry(self, client, method, path):
+        with self._lock:
+            self._endpoint(client, method, path).retries += 1
+
+
+    def record_jwt_mint(self, seconds):
+        with self._lock:
+            self.jwt_mints += 1
+            self.jwt_sign_seconds += seconds
+
+
+    def record_phase(self, name, seconds):
+        """Duration of a startup step, e.g. imports, config or planning"""
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+
+    def record_row(self, status=None):
+        with self._lock:
+            if self.rows == 0:
+                # Time until the first result - includes every startup step
+                self.phases['first_row'] = time.perf_counter() - self._started_counter
+            self.rows += 1
+            if status is not None:
+                self.row_statuses[status] = self.row_statuses.get(status, 0) + 1
+
+
+    def record_connections(self, client, opened, requests):
+        """Set the current connection pool counters of a client - called whenever a report is written"""
+        with self._lock:
+            self.connections[client] = {'opened': opened, 'requests': requests}
+
+
+    def _connection_totals(self):
+        totals = {client: dict(counts) for client, counts in self._merged_connections.items()}
+        for client, counts in self.connections.items():
+            client_totals = totals.setdefault(client, {'opened': 0, 'requests': 0})
+            client_totals['opened'] += counts['opened']
+            client_totals['requests'] += counts['requests']
+        return totals
+
+
+    def snapshot(self):
+        """Raw counters of this process, to be added to another process' metrics with merge()"""
+        with self._lock:
+            return {
+                'endpoints': {key: (stats.count, dict(stats.statuses), stats.retries, stats.latencies.tolist())
+                              for key, stats in self.endpoints.items()},
+                'jwt_mints': self.jwt_mints,
+                'jwt_sign_seconds': self.jwt_sign_seconds,
+                'connections': self._connection_totals()
+            }
+
+
+    def merge(self, snapshot):
+        with self._lock:
+            for (client, method, template), (count, statuses, retries, latencies) in snapshot['endpoints'].items():
+                stats = self._endpoint(client, method, template)
+                stats.count += count
+                stats.retries += retries
+                stats.latencies.extend(latencies)
+                for status, status_count in statuses.items():
+                    stats.statuses[status] = stats.statuses.get(status, 0) + status_count
+            self.jwt_mints += snapshot['jwt_mints']
+            self.jwt_sign_seconds += snapshot['jwt_sign_seconds']
+            for client, counts in snapshot['connections'].items():
+                totals = self._merged_connections.setdefault(client, {'opened': 0, 'requests': 0})
+                totals['opened'] += counts['opened']
+                totals['requests'] += counts['requests']
+
+
+    def summary(self):
+        with self._lock:
+            elapsed = time.time() - self.started
+            endpoints = []
+            for (client, method, template), stats in sorted(self.endpoints.items()):
+                endpoints.append({
+                    'client': client,
+                    'method': method,
+                    'endpoint': template,
+                    'calls': stats.count,
+                    'retries': stats.retries,
+                    'status_codes': dict(stats.statuses),
+                    'latency_seconds': {
+                        'total': sum(stats.latencies),
+                        'p50': percentile(stats.latencies, 0.50),
+                        'p90': percentile(stats.latencies, 0.90),
+                        'p99': percentile(stats.latencies, 0.99),
+                        'max': max(stats.latencies) if len(stats.latencies) > 0 else 0.0
+                    }
+                })
+
+            return {
+                'started': self.started,
+                'elapsed_seconds': elapsed,
+                'rows': self.rows,
+                'rows_per_second': self.rows / elapsed if elapsed > 0 else 0.0,
+                'calls': sum(e['calls'] for e in endpoints),
+                'retries': sum(e['retries'] for e in endpoints),
+                'jwt_mints': self.jwt_mints,
+                'jwt_sign_seconds': self.jwt_sign_seconds,
+                'phase_seconds': dict(self.phases),
+                'row_statuses': dict(sorted(self.row_statuses.items(), key=lambda item: -item[1])),
+                'connections': self._connection_totals(),
+                'endpoints': endpoints
+            }
+
+
+    def write_json(self, path):
+        write_atomically(path, json.dumps(self.summary(), indent=2))
+
+
+    def write_prometheus(self, path):
+        """Write the summary in the Prometheus textfile collector format"""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            """samples is a list of (suffix, labels, value)"""
+            lines.append(f'# HELP {PROMETHEUS_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {PROMETHEUS_PREFIX}_{name} {metric_type}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                label_text = '{' + label_text + '}' if label_text else ''
+                lines.append(f'{PROMETHEUS_PREFIX}_{name}{suffix}{label_text} {value}')
+
+        def labels(endpoint, **extra):
+            return dict({'client': endpoint['client'], 'method': endpoint['method'],
+                         'endpoint': endpoint['endpoint']}, **extra)
+
+        endpoints = summary['endpoints']
+        metric('api_calls_total', 'counter', 'API calls per endpoint and status code',
+               [('', labels(e, status=status), count) for e in endpoints
+                for status, count in sorted(e['status_codes'].items())])
+        metric('api_retries_total', 'counter', 'Retried API calls per endpoint',
+               [('', labels(e), e['retries']) for e in endpoints])
+        metric('api_call_latency_seconds', 'summary', 'API call latency per endpoint',
+               [('', labels(e, quantile=quantile), e['latency_seconds'][key]) for e in endpoints
+                for quantile, key in (('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99'))]
+               + [('_sum', labels(e), e['latency_seconds']['total']) for e in endpoints]
+               + [('_count', labels(e), e['calls']) for e in endpoints])
+        metric('jwt_mints_total', 'counter', 'JWTs signed during the run', [('', {}, summary['jwt_mints'])])
+        metric('phase_seconds', 'gauge', 'Duration of startup steps and time to the first row',
+               [('', {'phase': phase}, seconds) for phase, seconds in summary['phase_seconds'].items()])
+        metric('rows_total', 'counter', 'Input rows processed', [('', {}, summary['rows'])])
+        metric('run_duration_seconds', 'gauge', 'Run duration', [('', {}, summary['elapsed_seconds'])])
+        metric('run_rows_per_second', 'gauge', 'Rows processed per second', [('', {}, summary['rows_per_second'])])
+
+        write_atomically(path, '\n'.join(lines) + '\n')
+
+
+def write_atomically(path, content):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+# Metrics of the current run, shared by all clients
+run_metrics = RunMetrics()
@@ -0,0 +1,142 @@
+import csv
+import json
+import os
+from modules.metrics import run_metrics
+from modules.row_executor import run_ordered
+from modules.throttling import DeferredCallError
+
+CSV_FIELDS = ['UserID', 'First Name', 'Last Name', 'Display Name', 'External Network', 'Permission', 'Error']
+
+
+def export_permissions(clients, path, workers, resume=False):
+    """Write the permissions of every entitled advisor to path, returns the number of advisors exported.
+
+    The roster of each client's network is streamed and the permissions of up to `workers` advisors
+    are read in parallel through the clients' rate and concurrency limiters. path ending in .jsonl gets
+    one JSON object per advisor, any other path a CSV with one row per advisor and permission (advisors
+    without permissions get a single row with a blank Permission).
+
+    Completed advisors are recorded in path + '.journal' with the output size after their rows, so
+    a resumed export drops a partially written advisor and continues with the advisors not exported yet.
+    Advisors whose permissions could not be read because of the run deadline or an open circuit are
+    neither written nor journaled, so they are exported by the resumed export.
+    """
+    journal_path = path + '.journal'
+    completed, offset = read_audit_journal(journal_path) if resume else (set(), 0)
+    if resume:
+        print(f'Resuming - {len(completed)} advisor(s) already exported to {path}')
+        if os.path.exists(path):
+            os.truncate(path, offset)
+
+    jsonl = path.lower().endswith('.jsonl')
+    items = ((client, entitlement) for client in clients for entitlement in client.iter_entitlements()
+             if audit_key(client, entitlement) not in completed)
+    exported = 0
+    deferred = 0
+    with open(path, 'a' if resume else 'w', newline='', encoding='utf-8' if jsonl else 'utf-8-sig') as output_file, \
+            open(journal_path, 'a' if resume else 'w', encoding='utf-8') as journal_file:
+        if resume and journal_file.tell() > 0:
+            # Start on a fresh line in case the previous export stopped mid-write
+            journal_file.write('\n')
+        writer = None if jsonl else csv.DictWriter(output_file, fieldnames=CSV_FIELDS)
+        if writer is not None and output_file.tell() == 0:
+            writer.writeheader()
+
+        try:
+            for client, entitlement, permissions, error in run_ordered(read_advisor_permissions, items, workers):
+                if isinstance(error, DeferredCallError):
+                    deferred += 1
+                    run_metrics.record_row('EXPORT DEFERRED')
+                    continue
+
+                if jsonl:
+                    output_file.write(json.dumps(audit_record(client, entitlement, permissions, error)) + '\n')
+                else:
+                    write_audit_rows(writer, client, entitlement, permissions, error)
+                output_file.flush()
+                journal_file.write(json.dumps({'advisor': audit_key(client, entitlement),
+                                               'offset': output_file.tell()}) + '\n')
+                journal_file.flush()
+
+                exported += 1
+                run_metrics.record_row('EXPORTED' if error is None else 'EXPORT FAILED')
+                if exported % 1000 == 0:
+                    print(f'{exported} advisor(s) exported')
+
+        except DeferredCallError as ex:
+            # The roster could not be read to the end - the remaining advisors are left to the resumed export
+            print(f'Roster read stopped - {ex}')
+            deferred += 1
+
+    if deferred > 0:
+        print('Export incomplete - rerun with --resume to export the remaining advisor(s)')
+    return exported
+
+
+def read_advisor_permissions(item):
+    """Returns (client, entitlement, sorted permission names, error) - permissions is None on error.
+
+    error is the DeferredCallError itself when the call was not sent, see export_permissions.
+    """
+    client, entitlement = item
+    try:
+        output = client.list_permissions_by_advisor(entitlement['symphonyId'])
+        if isinstance(output, dict) and 'status' in output and 'title' in output:
+            return client, entitlement, None, f'{output["status"]} - {output["title"]}'
+        return client, entitlement, sorted(client.permission_names(output)), None
+
+    except DeferredCallError as ex:
+        print(f"Deferring permissions of {entitlement['symphonyId']} - {ex}")
+        return client, entitlement, None, ex
+    except Exception as ex:
+        print(f"Unable to read permissions for {entitlement['symphonyId']}: {ex}")
+        return client, entitlement, None, f'ERROR - {ex}'
+
+
+def audit_key(client, entitlement):
+    return f"{client.entitlementType}/{entitlement['symphonyId']}"
+
+
+def audit_record(client, entitlement, permissions, error):
+    record = {'symphonyId': entitlement['symphonyId'],
+              'firstName': entitlement.get('firstName', ''),
+              'lastName': entitlement.get('lastName', ''),
+              'displayName': entitlement.get('displayName', ''),
+              'externalNetwork': client.entitlementType,
+              'permissions': permissions}
+    if error is not None:
+        record['error'] = error
+    return record
+
+
+def write_audit_rows(writer, client, entitlement, permissions, error):
+    row = {'UserID': entitlement['symphonyId'],
+           'First Name': entitlement.get('firstName', ''),
+           'Last Name': entitlement.get('lastName', ''),
+           'Display Name': entitlement.get('displayName', ''),
+           'External Network': client.entitlementType,
+           'Permission': '',
+           'Error': error or ''}
+    if not permissions:
+        writer.writerow(row)
+    for permission in permissions or ():
+        writer.writerow(dict(row, Permission=permission))
+
+
+def read_audit_journal(journal_path):
+    """Return the advisors completed by a previous export and the output size after the last of them"""
+    completed = set()
+    offset = 0
+    if not os.path.exists(journal_path):
+        return completed, offset
+
+    with open(journal_path, 'r', encoding='utf-8') as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A partially written last line from a crash is ignored
+                continue
+            completed.add(entry['advisor'])
+            offset = entry['offset']
+    return completed, offset
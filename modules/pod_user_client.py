@@ -1,35 +1,157 @@
-from sym_api_client_python.configure.configure import SymConfig
-from sym_api_client_python.auth.rsa_auth import SymBotRSAAuth
-from sym_api_client_python.clients.sym_bot_client import SymBotClient
-from sym_api_client_python.clients.admin_client import AdminClient
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from modules.metrics import run_metrics
 
+# Users returned per admin_list_users call
+USER_PAGE_SIZE = 1000
+# Local cache of the user directory id index
+USER_CACHE_FILE = 'user_directory_cache.json'
+USER_CACHE_TTL = 3600
 
 
 class PodUserClient():
 
-    def __init__(self, appId):
-        # RSA Auth flow: pass path to rsa config.json file
-        configure = SymConfig('./resources/symphony_config.json')
-        configure.load_config()
-        auth = SymBotRSAAuth(configure)
-        auth.authenticate()
-
-        # Initialize SymBotClient with auth and configure objects
-        self.bot_client = SymBotClient(auth, configure)
-        self.admin_client = AdminClient(self.bot_client)
-        self.email_dict, self.username_dict = self.get_all_active_users()
+    def __init__(self, appId, cache_path=USER_CACHE_FILE, cache_ttl=USER_CACHE_TTL, workers=4):
+        # The pod session is only opened when a pod call is made, see connect
         self.appId = appId
+        self._bot_client = None
+        self._admin_client = None
+        self._connect_lock = threading.Lock()
+
+        # The user directory is only loaded when a lookup needs it
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self.workers = max(1, workers)
+        self._email_dict = None
+        self._username_dict = None
+        self._directory_lock = threading.Lock()
+
+
+    @property
+    def bot_client(self):
+        self.connect()
+        return self._bot_client
+
+
+    @property
+    def admin_client(self):
+        self.connect()
+        return self._admin_client
+
+
+    def connect(self):
+        """Authenticate to the pod on first use.
+
+        sym_api_client_python is only imported here, so runs that never call the pod do not pay for
+        the import or the authentication.
+        """
+        with self._connect_lock:
+            if self._bot_client is not None:
+                return
+
+            start = time.perf_counter()
+            from sym_api_client_python.configure.configure import SymConfig
+            from sym_api_client_python.auth.rsa_auth import SymBotRSAAuth
+            from sym_api_client_python.clients.sym_bot_client import SymBotClient
+            from sym_api_client_python.clients.admin_client import AdminClient
+
+            # RSA Auth flow: pass path to rsa config.json file
+            configure = SymConfig('./resources/symphony_config.json')
+            configure.load_config()
+            auth = SymBotRSAAuth(configure)
+            auth.auth_session.hooks['response'].append(self.record_pod_call)
+            auth.key_manager_auth_session.hooks['response'].append(self.record_pod_call)
+            auth.authenticate()
+
+            # Initialize SymBotClient with auth and configure objects
+            bot_client = SymBotClient(auth, configure)
+            bot_client.get_pod_session().hooks['response'].append(self.record_pod_call)
+            self._admin_client = AdminClient(bot_client)
+            self._bot_client = bot_client
+            run_metrics.record_phase('pod_connect', time.perf_counter() - start)
+
+
+    @property
+    def email_dict(self):
+        self.load_user_directory()
+        return self._email_dict
+
+
+    @property
+    def username_dict(self):
+        self.load_user_directory()
+        return self._username_dict
+
+
+    def load_user_directory(self):
+        """Load the email / username index from the local cache, or from the pod if the cache is stale"""
+        with self._directory_lock:
+            if self._email_dict is not None:
+                return
+
+            cached = self.read_directory_cache()
+            if cached is not None:
+                self._email_dict, self._username_dict = cached
+                return
+
+            print('Loading user directory from pod...')
+            self._email_dict, self._username_dict = self.get_all_active_users()
+            self.write_directory_cache(self._email_dict, self._username_dict)
+
+
+    def read_directory_cache(self):
+        if not self.cache_path or self.cache_ttl <= 0 or not os.path.exists(self.cache_path):
+            return None
+
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError) as ex:
+            print(f'Ignoring unreadable user directory cache {self.cache_path}: {ex}')
+            return None
+
+        if time.time() - cache.get('created', 0) > self.cache_ttl:
+            return None
+
+        print(f"Using cached user directory from {self.cache_path}")
+        return cache['email'], cache['username']
+
+
+    def write_directory_cache(self, email_dict, username_dict):
+        if not self.cache_path or self.cache_ttl <= 0:
+            return
+
+        # Write to a temporary file first so a concurrent reader never sees a partial cache
+        temp_path = self.cache_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump({'created': time.time(), 'email': email_dict, 'username': username_dict}, cache_file)
+        os.replace(temp_path, self.cache_path)
 
 
     def get_all_active_users(self):
-        output = self.admin_client.admin_list_users(skip=0, limit=1000)
+        output = self.admin_client.admin_list_users(skip=0, limit=USER_PAGE_SIZE)
+
+        # The first page tells the page size the pod returns - fetch the following pages concurrently,
+        # a wave at a time, until a short page shows the end of the directory
+        page_size = len(output)
+        skip = page_size
+        wave = 1 if page_size < USER_PAGE_SIZE else self.workers
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while page_size > 0:
+                skips = [skip + index * page_size for index in range(wave)]
+                pages = list(executor.map(
+                    lambda page_skip: self.admin_client.admin_list_users(skip=page_skip, limit=USER_PAGE_SIZE), skips))
+                for page in pages:
+                    output.extend(page)
 
-        while True:
-            next_out = self.admin_client.admin_list_users(skip=int(len(output)), limit=1000)
-            if len(next_out) > 0:
-                for index in range(len(next_out)): output.append(next_out[index])
-            else:
-                break
+                if any(len(page) < page_size for page in pages):
+                    break
+                skip += wave * page_size
+                wave = self.workers
 
         # Filter out Disabled users and create Dictionary
         email_dict = dict()
@@ -46,35 +168,63 @@ class PodUserClient():
         return email_dict, username_dict
 
     def install_connect_app_by_userid(self, user_id):
-        output = self.admin_get_user_features(user_id)
-        is_updated = False
+        return self.set_connect_app_by_userid(user_id, True)
+
+
+    def remove_connect_app_by_userid(self, user_id):
+        return self.set_connect_app_by_userid(user_id, False)
 
-        for o in output:
-            if o["appId"] == self.appId and o['install'] == False:
-                o['install'] = True
-                is_updated = True
-                break
 
+    def set_connect_app_by_userid(self, user_id, install):
+        """Set the install flag of the Connect app for one user, only posting the list if it changes"""
+        output = self.admin_get_user_features(user_id)
+        is_updated = self.set_connect_app_flag(output, install)
         if is_updated:
             self.admin_update_user_features(user_id, output)
 
         return is_updated
 
 
-    def remove_connect_app_by_userid(self, user_id):
-        output = self.admin_get_user_features(user_id)
-        is_updated = False
+    def set_connect_app_flag(self, features, install):
+        """Set the install flag of the Connect app in a user's feature list, returns True if it changed"""
+        for o in features:
+            if o["appId"] == self.appId and o['install'] != install:
+                o['install'] = install
+                return True
 
-        for o in output:
-            if o["appId"] == self.appId and o['install'] == True:
-                o['install'] = False
-                is_updated = True
-                break
+        return False
 
-        if is_updated:
-            self.admin_update_user_features(user_id, output)
 
-        return is_updated
+    def install_connect_app_bulk(self, user_ids):
+        return self.set_connect_app_bulk(user_ids, True)
+
+
+    def remove_connect_app_bulk(self, user_ids):
+        return self.set_connect_app_bulk(user_ids, False)
+
+
+    def set_connect_app_bulk(self, user_ids, install):
+        """Set the install flag of the Connect app for a set of users concurrently.
+
+        Feature lists are fetched in parallel and only users not already in the target state are updated.
+        Returns a dict of user_id -> True (updated), False (already in target state) or the raised Exception.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+
+        def apply(user_id):
+            try:
+                return self.set_connect_app_by_userid(user_id, install)
+            except Exception as ex:
+                return ex
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, max(1, len(user_ids)))) as executor:
+            return dict(zip(user_ids, executor.map(apply, user_ids)))
+
+
+    @staticmethod
+    def record_pod_call(response, *args, **kwargs):
+        run_metrics.record_call('pod', response.request.method, response.request.path_url,
+                                response.status_code, response.elapsed.total_seconds())
 
 
     def admin_get_user_features(self, user_id):
@@ -92,3 +242,91 @@ class PodUserClient():
             return self.email_dict[emailAddress]
 
         return None
+
+
+class AsyncPodUserClient(PodUserClient):
+    """asyncio variant of PodUserClient - the extension app calls are coroutines.
+
+    Feature lists are read and updated through SymBotClient.execute_rest_call_async, with at most
+    `workers` pod calls in flight. Authentication and the user directory are the synchronous ones.
+    """
+
+    def __init__(self, appId, cache_path=USER_CACHE_FILE, cache_ttl=USER_CACHE_TTL, workers=4):
+        super().__init__(appId, cache_path=cache_path, cache_ttl=cache_ttl, workers=workers)
+        self._pod_call_slots = None
+
+
+    async def connect_async(self):
+        # Authentication uses blocking calls - keep it off the event loop
+        if self._bot_client is None:
+            await asyncio.get_event_loop().run_in_executor(None, self.connect)
+
+
+    async def close(self):
+        if self._bot_client is not None:
+            await self._bot_client.close_async_sessions()
+
+
+    async def set_connect_app_by_userid(self, user_id, install):
+        output = await self.admin_get_user_features(user_id)
+        is_updated = self.set_connect_app_flag(output, install)
+        if is_updated:
+            await self.admin_update_user_features(user_id, output)
+
+        return is_updated
+
+
+    async def install_connect_app_by_userid(self, user_id):
+        return await self.set_connect_app_by_userid(user_id, True)
+
+
+    async def remove_connect_app_by_userid(self, user_id):
+        return await self.set_connect_app_by_userid(user_id, False)
+
+
+    async def install_connect_app_bulk(self, user_ids):
+        return await self.set_connect_app_bulk(user_ids, True)
+
+
+    async def remove_connect_app_bulk(self, user_ids):
+        return await self.set_connect_app_bulk(user_ids, False)
+
+
+    async def set_connect_app_bulk(self, user_ids, install):
+        """Returns a dict of user_id -> True (updated), False (already in target state) or the raised Exception"""
+        user_ids = list(dict.fromkeys(user_ids))
+
+        async def apply(user_id):
+            try:
+                return await self.set_connect_app_by_userid(user_id, install)
+            except Exception as ex:
+                return ex
+
+        return dict(zip(user_ids, await asyncio.gather(*[apply(user_id) for user_id in user_ids])))
+
+
+    async def admin_get_user_features(self, user_id):
+        url = '/pod/v1/admin/user/{0}/app/entitlement/list'.format(user_id)
+        return await self.execute_pod_call("GET", url)
+
+
+    async def admin_update_user_features(self, user_id, app_list):
+        url = '/pod/v1/admin/user/{0}/app/entitlement/list'.format(user_id)
+        return await self.execute_pod_call("POST", url, json=app_list)
+
+
+    async def execute_pod_call(self, method, url, **kwargs):
+        await self.connect_async()
+        if self._pod_call_slots is None:
+            self._pod_call_slots = asyncio.Semaphore(self.workers)
+
+        start = time.perf_counter()
+        try:
+            async with self._pod_call_slots:
+                output = await self._bot_client.execute_rest_call_async(method, url, **kwargs)
+        except Exception as ex:
+            run_metrics.record_call('pod', method, url, type(ex).__name__, time.perf_counter() - start)
+            raise
+        # The SDK raises on error statuses and does not expose the response
+        run_metrics.record_call('pod', method, url, '2xx', time.perf_counter() - start)
+        return output
@@ -0,0 +1,58 @@
+import hashlib
+import json
+import os
+
+
+class ResultJournal():
+    """Append-only journal of completed rows, used to resume an interrupted run.
+
+    Each line records the row number, a hash of the row content and the row result. A resumed run
+    only skips a row when both the row number and the content hash match, so an edited input file
+    never reuses a stale result. Entries are flushed as soon as they are written, so a crash loses
+    at most the rows that were still in flight.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.completed = dict()
+
+        if resume and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    if line.strip() == '':
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A partially written last line from a crash is ignored
+                        continue
+                    self.completed[entry['row']] = (entry['hash'], entry['result'])
+            print(f'Resuming - {len(self.completed)} completed row(s) found in {path}')
+
+        self.journal_file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        if resume and self.journal_file.tell() > 0:
+            # Start on a fresh line in case the previous run stopped mid-write
+            self.journal_file.write('\n')
+
+
+    @staticmethod
+    def row_hash(row):
+        return hashlib.sha1('\x1f'.join(row).encode('utf-8')).hexdigest()
+
+
+    def lookup(self, row_number, row_hash):
+        """Return the journaled result of a completed row, or None if the row must be processed"""
+        entry = self.completed.get(row_number)
+        if entry is not None and entry[0] == row_hash:
+            return entry[1]
+
+        return None
+
+
+    def record(self, row_number, row_hash, result):
+        self.journal_file.write(json.dumps({'row': row_number, 'hash': row_hash, 'result': result}) + '\n')
+        self.journal_file.flush()
+
+
+    def close(self):
+        self.journal_file.close()
@@ -0,0 +1,60 @@
+import threading
+
+# Row classifications used by reconcile mode
+NO_OP = 'NO_OP'
+ADD = 'ADD'
+REMOVE = 'REMOVE'
+
+
+class RosterIndex():
+    """In-memory index of the entitlement roster keyed by symphonyId.
+
+    Built once from EntitlementClient.iter_entitlements() so reconcile mode can decide which rows
+    need a write call without a lookup per row. The index is kept up to date as rows are applied,
+    so repeated rows for the same advisor in one file are classified correctly.
+    """
+
+    def __init__(self, entitlements):
+        self.entitlements = dict()
+        self._lock = threading.Lock()
+        for entitlement in entitlements:
+            self.entitlements[self.normalize_id(entitlement['symphonyId'])] = entitlement
+
+
+    @staticmethod
+    def normalize_id(symphony_id):
+        return str(symphony_id).strip().lower()
+
+
+    def __len__(self):
+        return len(self.entitlements)
+
+
+    def get(self, symphony_id):
+        with self._lock:
+            return self.entitlements.get(self.normalize_id(symphony_id))
+
+
+    def entries(self):
+        with self._lock:
+            return list(self.entitlements.values())
+
+
+    def classify(self, ent_action, symphony_id):
+        """Return ADD / REMOVE if a write is required to reach the desired state, NO_OP otherwise"""
+        entitled = self.get(symphony_id) is not None
+        if ent_action == "ADD" and not entitled:
+            return ADD
+        if ent_action == "REMOVE" and entitled:
+            return REMOVE
+        return NO_OP
+
+
+    def mark_added(self, symphony_id, entitlement=None):
+        with self._lock:
+            self.entitlements[self.normalize_id(symphony_id)] = entitlement or {'symphonyId': symphony_id}
+
+
+    def mark_removed(self, symphony_id):
+        with self._lock:
+            self.entitlements.pop(self.normalize_id(symphony_id), None)
@@ -0,0 +1,228 @@
+import asyncio
+import multiprocessing
+import queue
+import threading
+import traceback
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from modules.metrics import run_metrics
+
+
+def run_ordered(fn, items, workers):
+    """Apply fn to every item using up to `workers` threads and yield the results in input order.
+
+    Each item is handled by a single call to fn, so the steps for one item still run in sequence,
+    while independent items run in parallel. Only a bounded window of items is in flight at any time,
+    so the input is consumed lazily instead of being loaded up-front.
+    """
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # On error or interruption, do not start the items that are still queued
+            for future in pending:
+                future.cancel()
+
+
+async def run_ordered_async(fn, items, window):
+    """Async counterpart of run_ordered: await fn(item) for every item, up to `window` items at a time.
+
+    Results are yielded in input order and items are consumed lazily. Concurrency of the API calls
+    themselves is bounded by the clients, see AsyncEntitlementClient.
+    """
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(asyncio.ensure_future(fn(item)))
+            if len(pending) >= window:
+                yield await pending.popleft()
+
+        while pending:
+            yield await pending.popleft()
+    finally:
+        # On error or interruption, stop the items that are still running
+        for task in pending:
+            task.cancel()
+
+
+class EventLoopThread():
+    """An asyncio event loop running in a background thread, so synchronous code can drive coroutines.
+
+    run() waits for one coroutine, iterate() turns an async generator into a regular iterator, which
+    lets the async row loop feed the same output pipeline as the threaded one.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='event-loop', daemon=True)
+        self._thread.start()
+
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+    def iterate(self, async_iterator):
+        try:
+            while True:
+                try:
+                    yield self.run(async_iterator.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(async_iterator.aclose())
+
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+def run_steps(executor, steps):
+    """Run independent steps of one item concurrently and return their results in order.
+
+    The steps run on `executor`, which must not be the pool running the items themselves, so an item
+    waiting for its steps never holds the threads those steps need. Without an executor (or with a
+    single step) the steps run in sequence on the calling thread.
+    """
+    if executor is None or len(steps) <= 1:
+        return [step() for step in steps]
+
+    futures = [executor.submit(step) for step in steps]
+    return [future.result() for future in futures]
+
+
+def drive_steps(steps, executor=None):
+    """Run a step generator with blocking calls and return its result.
+
+    Step generators hold the decision logic shared by both transports (see main.row_steps) and
+    yield the I/O they need: a callable, whose result - or exception - is sent back into the
+    generator, or a list of step generators, run concurrently with run_steps and answered with the
+    list of their results.
+    """
+    result = error = None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+
+        result = error = None
+        try:
+            if isinstance(step, list):
+                result = run_steps(executor, [partial(drive_steps, s) for s in step])
+            else:
+                result = step()
+        except Exception as ex:
+            error = ex
+
+
+async def drive_steps_async(steps):
+    """drive_steps for the async transport - the calls return coroutines, which are awaited"""
+    result = error = None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+
+        result = error = None
+        try:
+            if isinstance(step, list):
+                result = list(await asyncio.gather(*[drive_steps_async(s) for s in step]))
+            else:
+                result = await step()
+        except Exception as ex:
+            error = ex
+
+
+def run_sharded(fn, items, processes, shard_key, threads=1, initializer=None, initargs=(), finalizer=None):
+    """Split items across worker processes by shard_key and yield fn's results in input order.
+
+    Items with the same shard key always go to the same process, which handles its shard with
+    run_ordered on `threads` threads. In each worker, initializer(*initargs) runs before the first
+    item and finalizer() after the last one. fn, initializer and finalizer must be module-level
+    functions, and items, initargs and results must be picklable. The workers' API metrics are
+    merged into this process' run_metrics.
+    """
+    context = multiprocessing.get_context('spawn')
+    shards = [[] for _ in range(processes)]
+    for index, item in enumerate(items):
+        shard = zlib.crc32(str(shard_key(item)).encode('utf-8')) % processes
+        shards[shard].append((index, item))
+    total = sum(len(shard) for shard in shards)
+
+    result_queue = context.Queue()
+    workers = [context.Process(target=_run_shard, daemon=True,
+                               args=(fn, shard, threads, initializer, initargs, finalizer, result_queue))
+               for shard in shards]
+    for worker in workers:
+        worker.start()
+
+    def receive():
+        while True:
+            try:
+                return result_queue.get(timeout=1)
+            except queue.Empty:
+                if any(worker.exitcode not in (None, 0) for worker in workers):
+                    raise Exception('Worker process exited unexpectedly')
+
+    try:
+        completed = dict()
+        next_index = 0
+        finished = 0
+        while next_index < total or finished < processes:
+            if next_index in completed:
+                yield completed.pop(next_index)
+                next_index += 1
+                continue
+
+            message = receive()
+            if message[0] == 'result':
+                completed[message[1]] = message[2]
+            elif message[0] == 'done':
+                run_metrics.merge(message[1])
+                finished += 1
+            else:
+                raise Exception(f'Worker process failed: {message[1]}')
+
+        for worker in workers:
+            worker.join()
+    finally:
+        # On error or interruption, stop the workers that are still running
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+
+def _run_shard(fn, shard, threads, initializer, initargs, finalizer, result_queue):
+    try:
+        if initializer is not None:
+            initializer(*initargs)
+
+        def apply(indexed_item):
+            return indexed_item[0], fn(indexed_item[1])
+
+        for index, result in run_ordered(apply, shard, threads):
+            result_queue.put(('result', index, result))
+
+        if finalizer is not None:
+            finalizer()
+        result_queue.put(('done', run_metrics.snapshot()))
+    except BaseException:
+        result_queue.put(('error', traceback.format_exc()))
@@ -0,0 +1,106 @@
+from collections import deque
+from modules.roster_index import RosterIndex
+from modules.row_record import RowRecord
+
+# Actions that are merged per advisor - other rows are executed on their own
+PLANNED_ACTIONS = ("ADD", "REMOVE")
+
+
+def coalesce_rows(records):
+    """Group the input rows per advisor and resolve each group to one operation.
+
+    Rows for the same advisor and network (ids compared with RosterIndex.normalize_id) become a single plan:
+    the last row's action wins and, for a final ADD, the permissions of the ADD rows after the
+    last REMOVE are unioned in the order they appear. Rows that failed validation or have no action
+    get a plan of their own so they are still reported.
+
+    Returns (plans, records) as deques: the plans in the order of each advisor's first row, and the
+    original rows, each linked to its plan. Use drain to release them as they are processed.
+    """
+    records = deque(records)
+    # First row of each plan, replaced by a list once a second row joins it
+    groups = []
+    group_by_key = dict()
+
+    for record in records:
+        key = None
+        if record.entitlement is None and record.action in PLANNED_ACTIONS:
+            key = (record.network, RosterIndex.normalize_id(record.advisor_id))
+
+        plan_index = group_by_key.get(key) if key is not None else None
+        if plan_index is None:
+            plan_index = len(groups)
+            groups.append(record)
+            if key is not None:
+                group_by_key[key] = plan_index
+        elif isinstance(groups[plan_index], list):
+            groups[plan_index].append(record)
+        else:
+            groups[plan_index] = [groups[plan_index], record]
+        record.plan_index = plan_index
+
+    plans = deque()
+    for plan_index, group in enumerate(groups):
+        plan = resolve_plan(group if isinstance(group, list) else [group])
+        plan.plan_index = plan_index
+        plans.append(plan)
+    return plans, records
+
+
+def resolve_plan(rows):
+    """Merge the rows of one advisor into a single record, processed like an input row.
+
+    A single row is its own plan; merged rows are linked to the new record through their plan field.
+    """
+    primary = rows[-1]
+    if len(rows) == 1:
+        return primary
+
+    permissions = []
+    for record in rows:
+        if record.action == "REMOVE":
+            permissions = []
+        elif record.action == "ADD":
+            for p in record.permission.split("~"):
+                p = p.strip()
+                if p != '' and p not in permissions:
+                    permissions.append(p)
+
+    plan = RowRecord(primary.row_number, primary.row_hash, primary.advisor_id, primary.action,
+                     '~'.join(permissions) if primary.action == "ADD" else primary.permission,
+                     primary.network, primary.network_column)
+    plan.rows = rows
+    for record in rows:
+        record.plan = plan
+    return plan
+
+
+def planned_actions(plans):
+    """Final action of every advisor (normalized id) per network - {advisor: {network: action}}"""
+    actions = dict()
+    for plan in plans:
+        if plan.entitlement is None and plan.action in PLANNED_ACTIONS:
+            actions.setdefault(RosterIndex.normalize_id(plan.advisor_id), dict())[plan.network] = plan.action
+    return actions
+
+
+def plan_rows(plan):
+    """The input rows an operation was planned from"""
+    return plan.rows if plan.rows is not None else [plan]
+
+
+def drain(items):
+    """Yield the items of a deque, removing each one so it can be released once it has been processed"""
+    while len(items) > 0:
+        yield items.popleft()
+
+
+def expand_plans(plans, records):
+    """Yield the original rows in input order as the plans they belong to complete.
+
+    plans must be yielded in plan order (see run_ordered); a row is released once its plan and
+    the plans of all earlier rows are done. records is drained as rows are yielded.
+    """
+    for plan_index, plan in enumerate(plans):
+        while len(records) > 0 and records[0].plan_index <= plan_index:
+            yield records.popleft()
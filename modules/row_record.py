@@ -0,0 +1,231 @@
+import csv
+import sys
+from modules.result_journal import ResultJournal
+
+# Entitlement outcomes
+ENTITLEMENT_INVALID_ACTION = 'INVALID_ACTION'
+ENTITLEMENT_MISSING_ID = 'MISSING_ID'
+ENTITLEMENT_INVALID_NETWORK = 'INVALID_NETWORK'
+ENTITLEMENT_ADDED = 'ADDED'
+ENTITLEMENT_REMOVED = 'REMOVED'
+ENTITLEMENT_UNCHANGED = 'UNCHANGED'
+# The API answered with an error payload - "status - title" is kept in entitlement_detail
+ENTITLEMENT_REJECTED = 'REJECTED'
+# The call raised - details are in the logs
+ENTITLEMENT_FAILED = 'FAILED'
+# Not sent - run deadline reached or circuit open, the reason is kept in entitlement_detail. Not journaled,
+# so a resumed run processes the row again
+ENTITLEMENT_DEFERRED = 'DEFERRED'
+
+# Extension app outcomes
+APP_UPDATED = 'UPDATED'
+APP_UNCHANGED = 'UNCHANGED'
+APP_FAILED = 'FAILED'
+# Not removed - the user stays entitled to another network, see main.stays_entitled
+APP_KEPT = 'KEPT'
+
+# Values accepted in the Network column
+NETWORKS = ('WHATSAPP', 'WECHAT', 'SMS')
+
+# Permission outcomes - stored as (outcome, permission name, detail) tuples
+PERMISSION_UNKNOWN = 'UNKNOWN'
+PERMISSION_HELD = 'HELD'
+PERMISSION_ADDED = 'ADDED'
+PERMISSION_REJECTED = 'REJECTED'
+PERMISSION_NOT_ADDED = 'NOT_ADDED'
+PERMISSION_ADD_FAILED = 'ADD_FAILED'
+PERMISSION_REVOKED = 'REVOKED'
+PERMISSION_REVOKE_FAILED = 'REVOKE_FAILED'
+PERMISSION_DEFERRED = 'DEFERRED'
+
+PERMISSION_MESSAGES = {
+    PERMISSION_UNKNOWN: 'ERROR - Unknown permission {name} - SKIPPED ',
+    PERMISSION_HELD: 'Permission {name} already granted ',
+    PERMISSION_ADDED: 'Permission {name} added successfully ',
+    PERMISSION_REJECTED: '{detail} ',
+    PERMISSION_NOT_ADDED: 'ERROR - Fail to add permission {name} ',
+    PERMISSION_ADD_FAILED: 'ERROR ADDING PERMISSION {name} - Check logs for details ',
+    PERMISSION_REVOKED: 'Permission {name} revoked successfully ',
+    PERMISSION_REVOKE_FAILED: 'ERROR REVOKING PERMISSION {name} - Check logs for details ',
+    PERMISSION_DEFERRED: 'Permission {name} DEFERRED - {detail} '
+}
+
+
+class RowRecord():
+    """One input row, or the merged operation of several rows (see row_planner), and its outcome.
+
+    Outcomes are kept as codes and rendered to the status text only when the row is written,
+    see render_status.
+    """
+    __slots__ = ('row_number', 'row_hash', 'advisor_id', 'action', 'permission', 'network', 'network_column',
+                 'plan', 'plan_index', 'rows', 'resumed', 'resumed_status',
+                 'entitlement', 'entitlement_detail', 'roster_entry', 'permissions', 'app_action', 'app_user_id',
+                 'app')
+
+    # Outcome fields, copied back from worker processes by copy_outcome
+    OUTCOME_FIELDS = ('entitlement', 'entitlement_detail', 'roster_entry', 'permissions', 'app_action',
+                      'app_user_id', 'app')
+
+    def __init__(self, row_number, row_hash, advisor_id, action, permission, network, network_column=False):
+        self.row_number = row_number
+        self.row_hash = row_hash
+        self.advisor_id = advisor_id
+        self.action = action
+        self.permission = permission
+        self.network = network
+        self.network_column = network_column
+        # Operation this row was merged into and its position - set by row_planner.coalesce_rows
+        self.plan = None
+        self.plan_index = None
+        # Rows merged into this operation - None when the operation is a single input row
+        self.rows = None
+        self.resumed = False
+        self.resumed_status = None
+        self.entitlement = None
+        self.entitlement_detail = None
+        # Entitlement returned by the API when it was created - used to keep a roster up to date
+        self.roster_entry = None
+        self.permissions = None
+        self.app_action = None
+        self.app_user_id = None
+        self.app = None
+
+
+    def add_permission_outcome(self, outcome, name, detail=None):
+        if self.permissions is None:
+            self.permissions = []
+        self.permissions.append((outcome, name, detail))
+
+
+    def detached(self):
+        """Copy of the operation without its rows, to be sent to another process.
+
+        The validation outcome set by read_rows is kept, so the worker does not send the row.
+        """
+        record = RowRecord(self.row_number, self.row_hash, self.advisor_id, self.action, self.permission,
+                           self.network, self.network_column)
+        record.resumed = self.resumed
+        record.entitlement = self.entitlement
+        record.entitlement_detail = self.entitlement_detail
+        return record
+
+
+    def copy_outcome(self, other):
+        for field in self.OUTCOME_FIELDS:
+            setattr(self, field, getattr(other, field))
+
+
+def read_rows(csvfile, default_network):
+    """Parse and validate the input file one row at a time.
+
+    The CSV file has 3 columns - advisorSymphonyId, Action (ADD / REMOVE), Permissions - and optionally
+    a 4th - Network (WHATSAPP / WECHAT / SMS), blank for default_network. Rows failing validation get
+    their outcome here and are not sent to the API.
+    """
+    csv_list = csv.reader(csvfile, delimiter=',')
+    for row in csv_list:
+        # Ignore blank rows
+        if len(row) == 0:
+            continue
+
+        # Ensure CSV has 3 or 4 columns
+        if len(row) not in (3, 4):
+            raise Exception(
+                'Invalid CSV File Format - Expect 3 or 4 columns - advisorSymphonyId, Action, Permissions, Network (optional)')
+
+        # Skip header row
+        if row[0] == "advisorSymphonyId":
+            continue
+
+        # Row number and content hash identify the row in the resume journal
+        # Actions, permission lists and networks repeat across rows - keep a single copy of each
+        network = (row[3].strip().upper() if len(row) == 4 else '') or default_network
+        record = RowRecord(csv_list.line_num, ResultJournal.row_hash(row), row[0].lower(), sys.intern(row[1].upper()),
+                           sys.intern(row[2]), sys.intern(network), len(row) == 4)
+
+        # Check if valid Entitlement Action, then that advisorSymphonyId is populated, then the Network
+        if record.action not in ("ADD", "REMOVE", ""):
+            record.entitlement = ENTITLEMENT_INVALID_ACTION
+        elif record.advisor_id == '':
+            record.entitlement = ENTITLEMENT_MISSING_ID
+        elif record.network_column and row[3].strip() != '' and record.network not in NETWORKS:
+            record.entitlement = ENTITLEMENT_INVALID_NETWORK
+
+        yield record
+
+
+def render_status(row, app_id):
+    """Status text of an input row, built from the outcome of the operation it belongs to"""
+    if row.resumed_status is not None:
+        return row.resumed_status
+
+    if row.plan is None:
+        return render_outcome(row, app_id)
+
+    plan = row.plan
+    status = render_outcome(plan, app_id)
+    if row is plan.rows[-1]:
+        return status
+
+    # An ADD row followed by a REMOVE lost its permissions in resolve_plan even if the last row is an ADD again
+    removed_later = row.action == "ADD" and \
+        any(later.action == "REMOVE" for later in plan.rows[plan.rows.index(row) + 1:])
+    if row.action == plan.action and not removed_later:
+        return f'Merged into row {plan.rows[-1].row_number} - {status}'
+    return f'Superseded by row {plan.rows[-1].row_number} - {status}'
+
+
+def is_deferred(record):
+    """True if any call of the operation was deferred - see ENTITLEMENT_DEFERRED"""
+    return record.entitlement == ENTITLEMENT_DEFERRED or \
+        any(outcome == PERMISSION_DEFERRED for outcome, name, detail in record.permissions or ())
+
+
+def render_outcome(record, app_id):
+    entitlement = record.entitlement
+    if entitlement == ENTITLEMENT_INVALID_ACTION:
+        return 'ERROR - Invalid Entitlement Action - SKIPPED'
+    if entitlement == ENTITLEMENT_MISSING_ID:
+        return 'ERROR - advisorSymphonyId field is not populated - SKIPPED'
+    if entitlement == ENTITLEMENT_INVALID_NETWORK:
+        return f'ERROR - Invalid Network {record.network} - SKIPPED'
+    if entitlement == ENTITLEMENT_DEFERRED:
+        return f'DEFERRED - {record.entitlement_detail} - Rerun with --resume'
+
+    parts = []
+    if record.action == "ADD":
+        if entitlement == ENTITLEMENT_UNCHANGED:
+            parts.append('Entitlement already in desired state. ')
+        elif entitlement == ENTITLEMENT_REJECTED:
+            parts.append(f'{record.entitlement_detail} ')
+        elif entitlement == ENTITLEMENT_ADDED:
+            parts.append('User added to Entitlement. ')
+        elif entitlement == ENTITLEMENT_FAILED:
+            parts.append('ERROR ADDING Entitlement - Check logs for details ')
+        # Also for an advisor already entitled, whose app was missing - see record_added_entitlement
+        if record.app == APP_UPDATED:
+            parts.append(f'{app_id} extension app installed Successfully! ')
+
+        for outcome, name, detail in record.permissions or ():
+            parts.append(PERMISSION_MESSAGES[outcome].format(name=name, detail=detail))
+
+    elif record.action == "REMOVE":
+        if entitlement == ENTITLEMENT_UNCHANGED:
+            parts.append('Entitlement already in desired state - SKIPPED ')
+        elif entitlement == ENTITLEMENT_REJECTED:
+            parts.append(f'{record.entitlement_detail} ')
+        elif entitlement == ENTITLEMENT_REMOVED and record.app == APP_UPDATED:
+            parts.append(f'User removed from Entitlement. {app_id} extension app removed Successfully! ')
+        elif entitlement == ENTITLEMENT_REMOVED and record.app == APP_KEPT:
+            parts.append(f'User removed from Entitlement. {app_id} extension app kept - entitled to another network ')
+        elif entitlement == ENTITLEMENT_REMOVED:
+            parts.append('Entitlement Removed successfully ')
+        elif entitlement == ENTITLEMENT_FAILED:
+            parts.append('ERROR REMOVING Entitlement - Check logs for details ')
+
+    if record.app == APP_FAILED:
+        parts.append(f'ERROR UPDATING {app_id} extension app - Check logs for details ')
+
+    status = ''.join(parts)
+    # REMOVE statuses never had a trailing space
+    return status.rstrip() if record.action == "REMOVE" else status
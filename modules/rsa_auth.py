@@ -1,5 +1,14 @@
 import datetime
+import threading
+import time
 from jose import jwt
+from modules.metrics import run_metrics
+
+# CES accepts tokens valid for up to 5 minutes, keep a small safety margin
+JWT_LIFETIME_SECONDS = 5*58
+# Mint a new token this many seconds before the current one expires
+JWT_REFRESH_MARGIN_SECONDS = 30
+
 
 class SymBotRSAAuth():
     """Class for RSA authentication"""
@@ -10,22 +19,66 @@ class SymBotRSAAuth():
         :param config: Object contains all RSA configurations
         """
         self.config = config
+        self.private_key = None
+        self.jwt = None
+        self.jwt_expiration = 0
+        # Number of JWTs signed by this instance - useful to measure the effect of the cache
+        self.jwt_mint_count = 0
+        self._lock = threading.RLock()
+
+
+    def load_private_key(self):
+        """Read the private key once, then keep it in memory"""
+        with self._lock:
+            if self.private_key is None:
+                with open(self.config.data['botRSAPath'], 'r') as f:
+                    self.private_key = f.read()
+
+            return self.private_key
 
 
     def create_jwt(self, entitlementType):
-        with open(self.config.data['botRSAPath'], 'r') as f:
-            content = f.readlines()
-            private_key = ''.join(content)
-            current_date = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
-            expiration_date = current_date + (5*58)
-
-            payload = {
-                    'sub': 'ces:customer:' + self.config.data['publicKeyId'],
-                    'exp': expiration_date,
-                    'iat': current_date
-            }
-
-
-            encoded = jwt.encode(payload, private_key, algorithm='RS512')
-            f.close()
-            return encoded
+        """Always sign a new JWT, see get_jwt for the cached variant"""
+        encoded, expiration_date = self._sign_jwt()
+        return encoded
+
+
+    def _sign_jwt(self):
+        start = time.perf_counter()
+        private_key = self.load_private_key()
+        current_date = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        expiration_date = current_date + JWT_LIFETIME_SECONDS
+
+        payload = {
+                'sub': 'ces:customer:' + self.config.data['publicKeyId'],
+                'exp': expiration_date,
+                'iat': current_date
+        }
+
+        encoded = jwt.encode(payload, private_key, algorithm='RS512')
+        with self._lock:
+            self.jwt_mint_count += 1
+        run_metrics.record_jwt_mint(time.perf_counter() - start)
+        return encoded, expiration_date
+
+
+    def get_jwt(self, entitlementType):
+        """Return the cached JWT, minting a new one when it is about to expire"""
+        with self._lock:
+            current_date = datetime.datetime.now(datetime.timezone.utc).timestamp()
+            if self.jwt is None or current_date >= self.jwt_expiration - JWT_REFRESH_MARGIN_SECONDS:
+                self.jwt, self.jwt_expiration = self._sign_jwt()
+
+            return self.jwt
+
+
+    def invalidate_jwt(self, rejected_jwt):
+        """Drop the cached JWT after the server rejected it.
+
+        Only the rejected token is dropped, so concurrent callers hitting a 401 with the same token
+        trigger a single refresh instead of discarding each other's fresh tokens.
+        """
+        with self._lock:
+            if self.jwt == rejected_jwt:
+                self.jwt = None
+                self.jwt_expiration = 0
@@ -0,0 +1,305 @@
+import asyncio
+import datetime
+import multiprocessing
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucketRateLimiter():
+    """Client-side rate limiter - acquire() blocks until a request may be sent.
+
+    A rate of 0 (or less) disables the limiter.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst) if burst else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+    async def acquire_async(self):
+        """acquire() for coroutines - waits without blocking the event loop"""
+        if self.rate <= 0:
+            return
+
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+
+    def _take(self):
+        """Take a token if one is available, otherwise return the seconds until the next one"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class SharedTokenBucketRateLimiter(TokenBucketRateLimiter):
+    """TokenBucketRateLimiter whose budget is shared by several processes.
+
+    The bucket lives in shared memory - create the limiter in the parent process and pass it to
+    the worker processes when they are started (see row_executor.run_sharded).
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst) if burst else max(1.0, self.rate)
+        # [tokens, last update] - time.monotonic() is system-wide, so it is comparable across processes
+        self._state = multiprocessing.get_context('spawn').Array('d', [self.capacity, time.monotonic()])
+
+
+    def _take(self):
+        with self._state.get_lock():
+            now = time.monotonic()
+            tokens = min(self.capacity, self._state[0] + (now - self._state[1]) * self.rate)
+            self._state[1] = now
+            if tokens >= 1:
+                self._state[0] = tokens - 1
+                return 0
+            self._state[0] = tokens
+            return (1 - tokens) / self.rate
+
+
+class AdaptiveConcurrencyLimiter():
+    """Caps the number of in-flight requests and adapts the cap to the server's health.
+
+    The cap is halved when the server throttles us and grows by one after a run of healthy
+    responses, never exceeding the configured maximum (additive increase, multiplicative decrease).
+    Use it as a context manager around each request.
+    """
+
+    def __init__(self, maximum, minimum=1, increase_after=20):
+        self.maximum = max(1, int(maximum))
+        self.minimum = max(1, min(int(minimum), self.maximum))
+        self.limit = self.maximum
+        self.in_flight = 0
+        self.increase_after = increase_after
+        self.healthy_responses = 0
+        self._condition = threading.Condition()
+
+
+    def __enter__(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+
+    def on_throttled(self):
+        with self._condition:
+            new_limit = max(self.minimum, self.limit // 2)
+            if new_limit != self.limit:
+                print(f'Throttled by server - reducing concurrency to {new_limit}')
+            self.limit = new_limit
+            self.healthy_responses = 0
+
+
+    def on_success(self):
+        with self._condition:
+            if self.limit >= self.maximum:
+                return
+            self.healthy_responses += 1
+            if self.healthy_responses >= self.increase_after:
+                self.limit += 1
+                self.healthy_responses = 0
+                self._condition.notify_all()
+
+
+class AsyncAdaptiveConcurrencyLimiter(AdaptiveConcurrencyLimiter):
+    """AdaptiveConcurrencyLimiter for coroutines - an adaptive semaphore used with `async with`.
+
+    Waiting callers are suspended instead of blocking the thread; use it from a single event loop.
+    """
+
+    def __init__(self, maximum, minimum=1, increase_after=20):
+        super().__init__(maximum, minimum, increase_after)
+        # Created on first use - before Python 3.10 asyncio primitives bind to the loop current when they are
+        # created, which is not the loop of the EventLoopThread using them
+        self._async_condition = None
+
+
+    def async_condition(self):
+        if self._async_condition is None:
+            self._async_condition = asyncio.Condition()
+        return self._async_condition
+
+
+    async def __aenter__(self):
+        condition = self.async_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        return self
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        condition = self.async_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+
+class DeferredCallError(Exception):
+    """A call was not sent because the API is considered unavailable - the row should be retried later"""
+
+
+class DeadlineExceededError(DeferredCallError):
+    pass
+
+
+class CircuitOpenError(DeferredCallError):
+    pass
+
+
+class UnavailableError(DeferredCallError):
+    """The call was sent but the API did not answer, or kept throttling / failing after the retries"""
+
+
+class RunDeadline():
+    """Time budget of a run, shared by every client. 0 seconds means no deadline.
+
+    Based on time.monotonic(), which is system-wide, so the deadline can be passed to worker processes.
+    """
+
+    def __init__(self, seconds=0):
+        self.seconds = float(seconds)
+        self.expires = None
+
+
+    def start(self):
+        self.expires = time.monotonic() + self.seconds if self.seconds > 0 else None
+
+
+    def stop(self):
+        self.expires = None
+
+
+    def remaining(self):
+        """Seconds left, None without a deadline"""
+        if self.expires is None:
+            return None
+        return self.expires - time.monotonic()
+
+
+class CircuitBreaker():
+    """Stops calling an endpoint that keeps failing.
+
+    The breaker opens after failure_threshold consecutive failed calls and rejects calls for
+    reset_seconds. It then lets a single probe call through (half-open): a success closes it again,
+    a failure re-opens it. A failure_threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_seconds=30.0):
+        self.name = name
+        self.failure_threshold = int(failure_threshold)
+        self.reset_seconds = float(reset_seconds)
+        self.failures = 0
+        self.opened = None
+        self.probe_started = None
+        self._lock = threading.Lock()
+
+
+    def allow(self):
+        """Return True if a call may be sent now"""
+        with self._lock:
+            if self.opened is None:
+                return True
+
+            now = time.monotonic()
+            if now - self.opened < self.reset_seconds:
+                return False
+            # Half-open - one probe at a time, a probe that never reported back is replaced
+            if self.probe_started is not None and now - self.probe_started < self.reset_seconds:
+                return False
+            self.probe_started = now
+            return True
+
+
+    def on_success(self):
+        with self._lock:
+            if self.opened is not None:
+                print(f'{self.name} is responding again - closing circuit')
+            self.failures = 0
+            self.opened = None
+            self.probe_started = None
+
+
+    def on_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failure_threshold <= 0:
+                return
+            if self.opened is not None or self.failures >= self.failure_threshold:
+                if self.opened is None:
+                    print(f'{self.failures} consecutive failures from {self.name} - opening circuit for '
+                          f'{self.reset_seconds:g}s')
+                self.opened = time.monotonic()
+                self.probe_started = None
+
+
+class CircuitBreakers():
+    """One CircuitBreaker per endpoint family, created on first use"""
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.breakers = dict()
+        self._lock = threading.Lock()
+
+
+    def get(self, name):
+        with self._lock:
+            breaker = self.breakers.get(name)
+            if breaker is None:
+                breaker = self.breakers[name] = CircuitBreaker(name, self.failure_threshold, self.reset_seconds)
+            return breaker
+
+
+def retry_delay(attempt, base_delay, retry_after=None, max_delay=60):
+    """Seconds to wait before the next attempt.
+
+    Honors a Retry-After header (seconds or HTTP date) when present, otherwise uses
+    exponential backoff with full jitter.
+    """
+    if retry_after:
+        try:
+            return min(max_delay, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+            delay = (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            return min(max_delay, max(0.0, delay))
+        except (TypeError, ValueError):
+            pass
+
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
@@ -0,0 +1,61 @@
+"""Base test case running main.py against benchmarks/mock_server.py"""
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_DIR = os.path.join(os.path.dirname(TESTS_DIR), 'benchmarks')
+sys.path.insert(0, BENCHMARK_DIR)
+
+from mock_server import MockServer, MockState, generate_certificate
+from throughput_benchmark import APP_ID, FIRST_ID, build_workspace
+
+
+class MockPipelineTest(unittest.TestCase):
+    app_id = ''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        cert_file, key_file = generate_certificate(self.temp_dir)
+        self.state = MockState(roster_size=0, user_count=10, first_id=FIRST_ID)
+        self.server = MockServer(self.state, cert_file, key_file, host='localhost')
+        self.server.start()
+        self.workspace = os.path.join(self.temp_dir, 'workspace')
+        build_workspace(self.workspace, self.server.server_address[1], cert_file, 0, 0, self.app_id)
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
+    def update_config(self, **settings):
+        config_file = os.path.join(self.workspace, 'resources', 'config.json')
+        with open(config_file) as f:
+            config = json.load(f)
+        config.update(settings)
+        with open(config_file, 'w') as f:
+            json.dump(config, f, indent=2)
+
+
+    def run_main(self, rows, *args):
+        with open(os.path.join(self.workspace, 'whatsapp_user_entitlements.csv'), 'w', newline='') as f:
+            f.write('advisorSymphonyId,Action,Permissions\n')
+            for row in rows:
+                f.write(','.join(row) + '\n')
+
+        # requests lets these variables override session.verify, which would ignore the truststorePath
+        env = {name: value for name, value in os.environ.items() if name not in ('REQUESTS_CA_BUNDLE', 'CURL_CA_BUNDLE')}
+        with open(os.path.join(self.workspace, 'workers.log'), 'w') as log:
+            subprocess.run([sys.executable, os.path.join(BENCHMARK_DIR, 'throughput_benchmark.py'), '--run-pipeline',
+                            self.workspace, '--'] + list(args), check=True, env=env, stdout=log)
+
+        with open(os.path.join(self.workspace, 'whatsapp_user_entitlements_output.csv'), newline='',
+                  encoding='utf-8-sig') as f:
+            return [row['Status'] for row in csv.DictReader(f)]
@@ -0,0 +1,36 @@
+"""Runs main.py against benchmarks/mock_server.py - python3 -m unittest discover tests"""
+import unittest
+
+from mock_pipeline import MockPipelineTest, APP_ID, FIRST_ID
+
+
+class AppRowsTest(MockPipelineTest):
+    app_id = APP_ID
+
+    def test_app_kept_while_entitled_to_another_network(self):
+        moved, still_entitled, removed = str(FIRST_ID), str(FIRST_ID + 1), str(FIRST_ID + 2)
+        for args in (('--concurrency', '2'), ('--processes', '2', '--concurrency', '2'), ('--transport', 'async'),
+                     ('--reconcile',)):
+            with self.subTest(args=args):
+                self.state.entitlements.clear()
+                for user_id in (moved, still_entitled, removed):
+                    self.state.add_entitlement(user_id, 'WHATSAPP')
+                    self.state.installed[user_id] = True
+                # Entitled before the run, with no row for that network
+                self.state.add_entitlement(still_entitled, 'WECHAT')
+
+                statuses = self.run_main([(moved, 'ADD', '', 'WECHAT'),
+                                          (moved, 'REMOVE', '', 'WHATSAPP'),
+                                          (still_entitled, 'REMOVE', '', 'WHATSAPP'),
+                                          (removed, 'REMOVE', '', 'WHATSAPP')], *args)
+
+                self.assertIn(f'{APP_ID} extension app kept', statuses[1])
+                self.assertIn(f'{APP_ID} extension app kept', statuses[2])
+                self.assertIn(f'{APP_ID} extension app removed Successfully!', statuses[3])
+                self.assertEqual(self.state.installed, {moved: True, still_entitled: True, removed: False})
+                self.assertIn((moved, 'WECHAT'), self.state.entitlements)
+                self.assertNotIn((moved, 'WHATSAPP'), self.state.entitlements)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+"""Runs main.py against benchmarks/mock_server.py - python3 -m unittest discover tests"""
+import unittest
+
+from mock_pipeline import MockPipelineTest, FIRST_ID
+
+
+class DeferredRowsTest(MockPipelineTest):
+
+    def test_unavailable_api_rows_are_resumed(self):
+        self.update_config(maxRetries=0)
+        rows = [(str(FIRST_ID + i), 'ADD', '') for i in range(12)]
+        for args in ((), ('--transport', 'async')):
+            with self.subTest(args=args):
+                self.state.entitlements.clear()
+                # Calls that got a 429 and the ones stopped by the open circuit are both deferred
+                self.server.throttle_rate = 1.0
+                statuses = self.run_main(rows, *args)
+                self.assertTrue(all(status.startswith('DEFERRED - ') for status in statuses), statuses)
+
+                self.server.throttle_rate = 0
+                statuses = self.run_main(rows, '--resume', *args)
+                self.assertTrue(all('User added to Entitlement.' in status for status in statuses), statuses)
+                self.assertEqual(len(self.state.entitlements), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""python3 -m unittest discover tests"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.inbox_watcher import InboxWatcher
+
+
+class InboxWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.inbox = tempfile.mkdtemp()
+        self.failed = os.path.join(self.inbox, 'failed')
+        os.makedirs(self.failed)
+        self.watcher = InboxWatcher(self.inbox, poll_seconds=0, settle_seconds=1.0)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.inbox, ignore_errors=True)
+
+
+    def drop(self, name, age=10):
+        path = os.path.join(self.inbox, name)
+        with open(path, 'w') as f:
+            f.write('advisorSymphonyId,Action,Permissions\n')
+        settled = time.time() - age
+        os.utime(path, (settled, settled))
+        return path
+
+
+    def test_unsettled_file_waits(self):
+        path = self.drop('rows.csv', age=0)
+        self.assertEqual(self.watcher.ready_files(), [])
+
+        os.utime(path, (time.time() - 10, time.time() - 10))
+        self.assertEqual(self.watcher.ready_files(), [path])
+
+
+    def test_unchanged_file_is_yielded_once(self):
+        path = self.drop('rows.csv')
+        self.assertEqual(self.watcher.ready_files(), [path])
+        self.assertEqual(self.watcher.ready_files(), [])
+
+
+    def test_file_dropped_again_is_yielded_again(self):
+        path = self.drop('rows.csv')
+        self.assertEqual(self.watcher.ready_files(), [path])
+
+        # Moved to failed/ by watch mode, then moved back by the operator - mv keeps mtime and size
+        failed_path = os.path.join(self.failed, 'rows.csv')
+        os.replace(path, failed_path)
+        self.assertEqual(self.watcher.ready_files(), [])
+        os.replace(failed_path, path)
+        self.assertEqual(self.watcher.ready_files(), [path])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+"""Runs main.py against benchmarks/mock_server.py - python3 -m unittest discover tests"""
+import unittest
+
+from mock_pipeline import MockPipelineTest, FIRST_ID
+
+
+class ShardedRowsTest(MockPipelineTest):
+
+    def test_invalid_rows_are_not_sent_by_workers(self):
+        statuses = self.run_main([(str(FIRST_ID), 'ADD', 'create:room'),
+                                  ('', 'ADD', 'create:room'),
+                                  (str(FIRST_ID + 1), 'BOGUS', '')],
+                                 '--processes', '2', '--concurrency', '2')
+
+        self.assertIn('User added to Entitlement.', statuses[0])
+        self.assertEqual(statuses[1], 'ERROR - advisorSymphonyId field is not populated - SKIPPED')
+        self.assertEqual(statuses[2], 'ERROR - Invalid Entitlement Action - SKIPPED')
+        self.assertEqual(self.state.stats()['calls'].get('POST /admin/api/v2/customer/entitlements'), 1)
+
+
+    def test_invalid_network_is_not_sent(self):
+        for args in (('--concurrency', '2'), ('--processes', '2', '--concurrency', '2'), ('--transport', 'async')):
+            with self.subTest(args=args):
+                statuses = self.run_main([(str(FIRST_ID + 2), 'ADD', '', 'TELEGRAM'),
+                                          (str(FIRST_ID + 3), 'ADD', '', 'sms')], *args)
+
+                self.assertEqual(statuses[0], 'ERROR - Invalid Network TELEGRAM - SKIPPED')
+                self.assertNotIn((str(FIRST_ID + 2), 'TELEGRAM'), self.state.entitlements)
+                self.assertIn((str(FIRST_ID + 3), 'SMS'), self.state.entitlements)
+
+
+if __name__ == '__main__':
+    unittest.main()